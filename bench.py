@@ -0,0 +1,437 @@
+"""
+Бенчмарк выгрузок и учёта активности: замеряет этапы формирования отчётов
+(spool, CSV, сжатие, Parquet, Excel) и запись статистики чатов
+на синтетических данных в формате реальных отчётов.
+
+Для каждого этапа выводятся перцентили времени, пропускная способность и пиковый RSS.
+Результаты можно сохранить как базовые (--save-baseline) и сравнивать с ними
+следующие запуски (--baseline): при замедлении p50 сверх --tolerance код выхода 1.
+
+Запись статистики в БД замеряется, если задан BENCH_DB_URL (или --db-url) – локальный Postgres,
+например: docker run -e POSTGRES_HOST_AUTH_METHOD=trust -p 5432:5432 postgres:16.
+Таблицы создаются во временной схеме, которая удаляется после замера.
+
+Запуск: python bench.py --rows 200000 --shape users --repeat 5
+"""
+import argparse
+import asyncio
+import datetime
+import inspect
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from decimal import Decimal
+
+import asyncpg
+
+import bot
+
+# ----------------------------
+# Синтетические данные
+# ----------------------------
+
+class FakeRecord(tuple):
+    """
+    Кортеж с методом keys(), как у asyncpg.Record, – этого достаточно для spool_records.
+    """
+
+    __slots__ = ()
+    columns = ()
+
+    def keys(self):
+        return self.columns
+
+
+class UserRecord(FakeRecord):
+    # Форма «Выгрузка всех пользователей»
+    __slots__ = ()
+    columns = ("id", "telegram_id", "username", "balance", "lessons_count", "referral_count",
+               "donation_stars", "tasks_count", "current_streak", "has_ton_wallet")
+
+
+class ActivationRecord(FakeRecord):
+    # Форма «Выгрузка активированности юзеров»
+    __slots__ = ()
+    columns = ("tg", "tg_id", "crypton_id", "balance", "lessons_passed", "referral_count", "days_in_app",
+               "claims_count", "donated_amount", "story_views", "max_nut_run_day", "current_nut_run_day",
+               "tasks_completed")
+
+
+def make_user(i: int, rnd: random.Random) -> UserRecord:
+    return UserRecord((
+        i,
+        5000000000 + rnd.randrange(10 ** 9),
+        f"user_{rnd.randrange(10 ** 7)}" if rnd.random() < 0.8 else None,
+        Decimal(rnd.randrange(10 ** 7)) / 100,
+        rnd.randrange(60),
+        rnd.randrange(20) if rnd.random() < 0.3 else 0,
+        rnd.choice((0, 0, 0, 50, 100, 250)),
+        rnd.randrange(40),
+        rnd.randrange(30),
+        rnd.random() < 0.25,
+    ))
+
+
+def make_activation(i: int, rnd: random.Random) -> ActivationRecord:
+    return ActivationRecord((
+        f"user_{rnd.randrange(10 ** 7)}" if rnd.random() < 0.8 else None,
+        5000000000 + rnd.randrange(10 ** 9),
+        f"cg-{rnd.randrange(16 ** 12):012x}",
+        Decimal(rnd.randrange(10 ** 7)) / 100,
+        rnd.randrange(60),
+        rnd.randrange(20) if rnd.random() < 0.3 else 0,
+        rnd.randrange(400),
+        rnd.randrange(500),
+        Decimal(rnd.choice((0, 0, 0, 50, 100, 250))),
+        rnd.randrange(100),
+        rnd.randrange(60),
+        rnd.randrange(30),
+        rnd.randrange(40),
+    ))
+
+
+SHAPES = {
+    "users": (make_user, UserRecord),
+    "activation": (make_activation, ActivationRecord),
+}
+
+
+async def synthetic_chunks(shape: str, rows: int, chunk_size: int, seed: int = 42):
+    make_row = SHAPES[shape][0]
+    rnd = random.Random(seed)
+    for start in range(0, rows, chunk_size):
+        yield [make_row(i, rnd) for i in range(start, min(start + chunk_size, rows))]
+
+
+def activity_messages(count: int, chats: int, users: int, seed: int = 42):
+    """
+    Сообщения групповых чатов: (chat_id, user_id, chat_title, chat_topic, длина текста).
+    Активность пользователей неравномерна, как в реальных чатах.
+    """
+    rnd = random.Random(seed)
+    for _ in range(count):
+        chat_id = -1000000000000 - rnd.randrange(chats)
+        user_id = int(rnd.paretovariate(1.2) * 1000) % users + 1
+        yield chat_id, user_id, f"Чат {chat_id}", None, rnd.randrange(1, 400)
+
+# ----------------------------
+# Замеры
+# ----------------------------
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Без /proc доступен только пиковый RSS за всё время работы процесса
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RssSampler:
+    """
+    Пиковый RSS процесса за время этапа: фоновый поток опрашивает RSS каждые interval секунд.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class StageResult:
+    """
+    Замер этапа: samples – длительности повторов этапа (или отдельных операций при per_operation),
+    rows и size – объём данных, обработанный за один повтор (за все операции).
+    """
+
+    def __init__(self, name: str, samples: list, rows: int, size: int, peak_rss: int, per_operation: bool = False):
+        self.name = name
+        self.samples = samples
+        self.rows = rows
+        self.size = size
+        self.peak_rss = peak_rss
+        self.per_operation = per_operation
+
+    def to_dict(self) -> dict:
+        elapsed = sum(self.samples) if self.per_operation else percentile(self.samples, 0.5)
+        return {
+            "p50": percentile(self.samples, 0.5),
+            "p90": percentile(self.samples, 0.9),
+            "p99": percentile(self.samples, 0.99),
+            "rows_per_s": self.rows / elapsed if elapsed else 0.0,
+            "mb_per_s": self.size / (1024 * 1024) / elapsed if elapsed else 0.0,
+            "size_mb": self.size / (1024 * 1024),
+            "peak_rss_mb": self.peak_rss / (1024 * 1024),
+        }
+
+
+async def run_stage(name: str, func, repeat: int) -> StageResult:
+    """
+    Выполняет этап repeat раз. func() (обычная или корутина) возвращает (rows, size) –
+    число обработанных строк и размер результата в байтах.
+    """
+    samples = []
+    peak = rows = size = 0
+    for _ in range(repeat):
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            outcome = func()
+            if inspect.isawaitable(outcome):
+                outcome = await outcome
+            samples.append(time.perf_counter() - started)
+        rows, size = outcome
+        peak = max(peak, rss.peak)
+    return StageResult(name, samples, rows, size, peak)
+
+# ----------------------------
+# Этапы выгрузки
+# ----------------------------
+
+async def bench_export(shape: str, args, work_dir: str) -> list:
+    results = []
+    spool_path = os.path.join(work_dir, f"{shape}.spool")
+    spooled = {}
+
+    async def spool_stage():
+        # Генерация синтетических строк входит в замер, как выборка из БД в реальной выгрузке
+        spooled["columns"], rows_count, _ = await bot.spool_records(
+            synthetic_chunks(shape, args.rows, args.chunk_size), spool_path
+        )
+        return rows_count, os.path.getsize(spool_path)
+
+    results.append(await run_stage(f"{shape}/spool", spool_stage, args.repeat))
+    columns = spooled["columns"]
+
+    def encode_stage(encoder, path, **options):
+        def stage():
+            encoder(spool_path, columns, path, **options)
+            return args.rows, os.path.getsize(path)
+        return stage
+
+    if "csv" in args.stage:
+        results.append(await run_stage(
+            f"{shape}/csv", encode_stage(bot.generate_csv, os.path.join(work_dir, "plain.csv")), args.repeat
+        ))
+    if "zip" in args.stage:
+        for name in args.codec:
+            results.append(await run_stage(
+                f"{shape}/csv+{name}",
+                encode_stage(bot.generate_csv, os.path.join(work_dir, f"{name}.zip"),
+                             codec=bot.COMPRESSION_CODECS[name]),
+                args.repeat,
+            ))
+    if "parquet" in args.stage:
+        results.append(await run_stage(
+            f"{shape}/parquet", encode_stage(bot.generate_parquet, os.path.join(work_dir, "report.parquet")),
+            args.repeat,
+        ))
+    if "excel" in args.stage:
+        results.append(await run_stage(
+            f"{shape}/excel", encode_stage(bot.generate_excel, os.path.join(work_dir, "report.xlsx")), args.repeat
+        ))
+    return results
+
+# ----------------------------
+# Этапы учёта активности
+# ----------------------------
+
+async def bench_activity_memory(args) -> list:
+    """
+    Горячий путь track_activity без БД: буфер статистики чатов и статистика пользователей.
+    Замеряется каждая операция; сброс буфера в БД отключён.
+    """
+    messages = list(activity_messages(args.messages, args.chats, args.users))
+    results = []
+
+    buffer = bot.ActivityBuffer(flush_interval=3600, flush_size=len(messages) + 1, max_size=len(messages) + 1)
+    samples = []
+    with RssSampler() as rss:
+        for message in messages:
+            started = time.perf_counter()
+            await buffer.add(*message)
+            samples.append(time.perf_counter() - started)
+    results.append(StageResult("activity/buffer_add", samples, len(messages), 0, rss.peak, per_operation=True))
+
+    store = bot.ActivityStatsStore(args.users, snapshot_interval=3600)
+    samples = []
+    with RssSampler() as rss:
+        for _, user_id, _, _, length in messages:
+            started = time.perf_counter()
+            store.add(user_id, length)
+            samples.append(time.perf_counter() - started)
+    results.append(StageResult("activity/stats_add", samples, len(messages), 0, rss.peak, per_operation=True))
+    return results
+
+
+def activity_batches(args):
+    # Пачки в формате ActivityBuffer: по --flush-size пар чат/пользователь
+    batch = {}
+    for chat_id, user_id, title, topic, length in activity_messages(args.messages, args.chats, args.users):
+        entry = batch.get((chat_id, user_id))
+        if entry is None:
+            batch[(chat_id, user_id)] = [1, length, title, topic]
+            if len(batch) >= args.flush_size:
+                yield batch
+                batch = {}
+        else:
+            entry[0] += 1
+            entry[1] += length
+    if batch:
+        yield batch
+
+
+async def bench_activity_db(args) -> list:
+    """
+    Запись статистики в БД (upsert_activity_batch) во временной схеме: замеряется каждый сброс пачки.
+    """
+    schema = f"bench_{os.getpid()}"
+    conn = await asyncpg.connect(args.db_url)
+    await conn.execute(f"CREATE SCHEMA {schema}")
+    # Неизвестные параметры строки подключения asyncpg передаёт серверу как настройки сессии
+    separator = "&" if "?" in args.db_url else "?"
+    bot.DB_POOLS = bot.PoolRegistry({bot.STATS_DB: f"{args.db_url}{separator}search_path={schema}"})
+    try:
+        await bot.init_stats_table()
+        await bot.init_activity_history_table()
+        samples = []
+        keys = 0
+        with RssSampler() as rss:
+            for batch in activity_batches(args):
+                started = time.perf_counter()
+                await bot.upsert_activity_batch(batch)
+                samples.append(time.perf_counter() - started)
+                keys += len(batch)
+        return [StageResult("activity/upsert", samples, keys, 0, rss.peak, per_operation=True)]
+    finally:
+        await bot.DB_POOLS.close()
+        await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+        await conn.close()
+
+# ----------------------------
+# Отчёт и сравнение с базовым запуском
+# ----------------------------
+
+def format_seconds(value: float) -> str:
+    if value < 0.001:
+        return f"{value * 1e6:.0f} мкс"
+    if value < 1:
+        return f"{value * 1000:.1f} мс"
+    return f"{value:.2f} с"
+
+
+def print_results(stages: dict, baseline: dict = None, tolerance: float = 0.1) -> list:
+    """
+    Печатает таблицу замеров и возвращает этапы, у которых p50 вырос относительно baseline больше чем на tolerance.
+    """
+    regressions = []
+    print(f"\n{'этап':<26}{'p50':>11}{'p90':>11}{'p99':>11}{'строк/с':>12}"
+          f"{'МБ':>8}{'МБ/с':>8}{'RSS, МБ':>9}{'к базе':>9}")
+    for name, stage in stages.items():
+        delta = ""
+        base = (baseline or {}).get(name)
+        if base and base["p50"]:
+            change = stage["p50"] / base["p50"] - 1
+            delta = f"{change:+.0%}"
+            if change > tolerance:
+                delta += " !"
+                regressions.append(name)
+        print(f"{name:<26}{format_seconds(stage['p50']):>11}{format_seconds(stage['p90']):>11}"
+              f"{format_seconds(stage['p99']):>11}{stage['rows_per_s']:>12,.0f}{stage['size_mb']:>8.1f}"
+              f"{stage['mb_per_s']:>8.1f}{stage['peak_rss_mb']:>9.0f}{delta:>9}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--shape", choices=sorted(SHAPES), action="append")
+    parser.add_argument("--chunk-size", type=int, default=bot.EXPORT_CHUNK_SIZE)
+    parser.add_argument("--repeat", type=int, default=3, help="повторов каждого этапа выгрузки")
+    parser.add_argument("--stage", choices=("csv", "zip", "parquet", "excel", "activity"), action="append")
+    parser.add_argument("--codec", choices=sorted(bot.COMPRESSION_CODECS), action="append")
+    parser.add_argument("--messages", type=int, default=200000, help="сообщений для этапов активности")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--flush-size", type=int, default=bot.ACTIVITY_FLUSH_SIZE)
+    parser.add_argument("--db-url", default=os.getenv("BENCH_DB_URL", ""))
+    parser.add_argument("--baseline", help="JSON с базовыми результатами для сравнения")
+    parser.add_argument("--save-baseline", help="сохранить результаты в JSON")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="допустимый рост p50 (доля)")
+    args = parser.parse_args()
+    args.stage = args.stage or ["csv", "zip", "parquet", "excel", "activity"]
+    args.codec = args.codec or ["deflate1", "deflate6"]
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        for shape in args.shape or sorted(SHAPES):
+            results.extend(await bench_export(shape, args, work_dir))
+        if "activity" in args.stage:
+            results.extend(await bench_activity_memory(args))
+            if args.db_url:
+                results.extend(await bench_activity_db(args))
+            else:
+                print("BENCH_DB_URL не задан, замер записи статистики в БД пропущен")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "date": f"{datetime.datetime.now():%Y-%m-%d %H:%M}",
+            "rows": args.rows,
+            "messages": args.messages,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "stages": {result.name: result.to_dict() for result in results},
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline["meta"]["rows"], baseline["meta"]["messages"]) != (args.rows, args.messages):
+            print("Внимание: базовый замер сделан на другом объёме данных")
+    regressions = print_results(report["stages"], baseline and baseline["stages"], args.tolerance)
+    print(f"\nЗамер: {report['meta']['date']}, Python {report['meta']['python']}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.save_baseline}")
+    if regressions:
+        print(f"Рост p50 больше {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -3,19 +3,46 @@ import zipfile
 import logging
 import asyncio
 import asyncpg
+import bisect
+import contextlib
+import datetime
+import decimal
+import functools
+import hashlib
 import io
+import itertools
+import json
+import pickle
+import re
+import shutil
+import signal
+import tempfile
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from zoneinfo import ZoneInfo
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton, FSInputFile, BufferedInputFile, InputFile
 )
 from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
 
 # Импорты для работы с состояниями (FSM)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import csv
 from dotenv import load_dotenv
 
@@ -38,6 +65,133 @@ DATABASE_URLS = {
     "analytics_bot": os.getenv("CHATS_ANALYTICS_DB_URL", ""),
 }
 
+# Имя пула для базы статистики (STATS_DB_URL) в реестре пулов
+STATS_DB = "stats"
+
+# Размеры пулов соединений по умолчанию
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Интервал проверки здоровья пулов (в секундах)
+DB_POOL_HEALTH_INTERVAL = int(os.getenv("DB_POOL_HEALTH_INTERVAL", "60"))
+# Сколько подготовленных запросов asyncpg хранит на каждое соединение
+# (0 отключает кэш – нужно при работе через pgbouncer в режиме transaction)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Реплики для чтения, на которые направляются запросы отчётов.
+# Формат переменной DB_REPLICA_URLS: "nutsfarm=postgresql://replica1/db postgresql://replica2/db;stats=postgresql://replica3/db"
+# (реплики одной БД – через пробел, базы – через точку с запятой)
+DB_REPLICA_URLS = {}
+for entry in os.getenv("DB_REPLICA_URLS", "").split(";"):
+    name, _, urls = entry.partition("=")
+    if name.strip() and urls.split():
+        DB_REPLICA_URLS[name.strip()] = urls.split()
+# Допустимое отставание реплики (в секундах): более отстающая реплика не получает запросы
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "30"))
+# Интервал проверки доступности и отставания реплик (в секундах)
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10"))
+
+# Параметры буферизации статистики активности:
+# интервал сброса (сек), размер буфера для досрочного сброса и жёсткий лимит (число пар чат/пользователь)
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5"))
+ACTIVITY_FLUSH_SIZE = int(os.getenv("ACTIVITY_FLUSH_SIZE", "1000"))
+ACTIVITY_BUFFER_LIMIT = int(os.getenv("ACTIVITY_BUFFER_LIMIT", "50000"))
+# Статистика пользователей для /my_stats и /all_stats: число пользователей в памяти,
+# интервал сохранения приращений в БД (сек) и размер страницы /all_stats
+ACTIVITY_STATS_MAX_USERS = int(os.getenv("ACTIVITY_STATS_MAX_USERS", "100000"))
+ACTIVITY_STATS_SNAPSHOT_INTERVAL = float(os.getenv("ACTIVITY_STATS_SNAPSHOT_INTERVAL", "60"))
+ALL_STATS_PAGE_SIZE = int(os.getenv("ALL_STATS_PAGE_SIZE", "50"))
+
+# Размер порции строк, читаемой из серверного курсора при выгрузке отчётов
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+# Каталог для временных файлов отчётов (по умолчанию системный)
+REPORTS_TMP_DIR = os.getenv("REPORTS_TMP_DIR") or None
+# Пороговый размер CSV, после которого отчёт сжимается (50 МБ)
+THRESHOLD_SIZE = 50 * 1024 * 1024
+# Кодек сжатия крупных CSV: "auto" (выбор по объёму и бюджету времени), "store", "deflate1", "deflate6", "deflate9", "lzma"
+COMPRESSION_CODEC = os.getenv("COMPRESSION_CODEC", "auto").lower()
+# Бюджет времени на сжатие одного отчёта в режиме "auto" (в секундах)
+COMPRESSION_TIME_BUDGET = float(os.getenv("COMPRESSION_TIME_BUDGET", "30"))
+# Максимальный размер одной части выгрузки (лимит загрузки для ботов в Telegram – 50 МБ,
+# запас оставлен на данные, которые кодек сжатия ещё не сбросил в файл)
+EXPORT_PART_SIZE = int(os.getenv("EXPORT_PART_SIZE", str(45 * 1024 * 1024)))
+# Сколько частей одной выгрузки загружается в Telegram одновременно
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "2"))
+# Пул для кодирования и сжатия отчётов: "thread" или "process", и число воркеров
+REPORT_EXECUTOR_KIND = os.getenv("REPORT_EXECUTOR_KIND", "thread").lower()
+REPORT_EXECUTOR_WORKERS = int(os.getenv("REPORT_EXECUTOR_WORKERS", "4"))
+
+# Максимальный суммарный объём кэша результатов запросов (в байтах)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Отдельный бюджет для заранее подготовленных результатов (pregenerate): тяжёлые выгрузки
+# не должны вытесняться обычными запросами и не помещаются в общий бюджет
+RESULT_CACHE_PRELOAD_MAX_BYTES = int(os.getenv("RESULT_CACHE_PRELOAD_MAX_BYTES", str(8 * 1024 * 1024 * 1024)))
+
+# Ограничения запросов отчётов по умолчанию (для отдельного запроса задаются параметрами в SERVICE_QUERIES):
+# предельное время выполнения (в секундах) и бюджет оценки планировщика – стоимость и число строк (0 – без ограничения).
+# Запрос сверх бюджета уходит в фоновую очередь, а превышающий его в QUERY_REJECT_FACTOR раз отклоняется
+# (выгрузки – kind "export" – не отклоняются, а всегда выполняются в фоне)
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", "600"))
+QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", "1000000"))
+QUERY_MAX_ROWS = int(os.getenv("QUERY_MAX_ROWS", "0"))
+QUERY_REJECT_FACTOR = float(os.getenv("QUERY_REJECT_FACTOR", "10"))
+
+# Ограничение числа одновременно выполняемых отчётов для каждой БД.
+# Формат переменной DB_CONCURRENCY: "nutsfarm:2,stats:4"
+DB_CONCURRENCY_DEFAULT = int(os.getenv("DB_CONCURRENCY_DEFAULT", "2"))
+db_concurrency_env = os.getenv("DB_CONCURRENCY", "")
+DB_CONCURRENCY = {}
+for entry in db_concurrency_env.split(","):
+    parts = entry.split(":")
+    if len(parts) == 2:
+        try:
+            DB_CONCURRENCY[parts[0].strip()] = int(parts[1])
+        except ValueError:
+            pass
+# Минимальный интервал между обновлениями сообщения о ходе выполнения отчёта (в секундах)
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "3"))
+
+# Часовой пояс расписаний предварительной подготовки отчётов и подписок
+SCHEDULE_TIMEZONE = ZoneInfo(os.getenv("SCHEDULE_TIMEZONE", "UTC"))
+# Время хранения заранее подготовленного результата (в секундах)
+PREGENERATE_TTL = int(os.getenv("PREGENERATE_TTL", str(26 * 3600)))
+# Служебный чат, в который загружаются заранее подготовленные отчёты, чтобы получить их file_id
+ARTIFACT_CHAT_ID = int(os.getenv("ARTIFACT_CHAT_ID", "0")) or None
+
+# Интервал обновления дневных роллапов активности Nutsfarm (в секундах)
+ROLLUP_INTERVAL = int(os.getenv("ROLLUP_INTERVAL", "3600"))
+# Адрес HTTP-эндпоинта метрик в формате Prometheus (/metrics); METRICS_PORT=0 отключает эндпоинт
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Сколько последних замеров каждой метрики хранится для перцентилей /perf
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1000"))
+
+# Режим получения обновлений: "polling" или "webhook" (несколько реплик за балансировщиком)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный URL вебхука, путь и адрес, на которых его слушает бот, и секрет для проверки запросов Telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Хранилище состояний диалогов (FSM): "postgres" (БД статистики, общее для всех реплик) или "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres").lower()
+# Идентификатор процесса бота: по нему кнопка отмены находит реплику, выполняющую задание
+REPLICA_ID = uuid.uuid4().hex[:8]
+# Почасовая история активности чатов: срок хранения (дней) и на сколько дней вперёд создаются партиции
+ACTIVITY_RETENTION_DAYS = int(os.getenv("ACTIVITY_RETENTION_DAYS", "90"))
+ACTIVITY_PARTITIONS_AHEAD = int(os.getenv("ACTIVITY_PARTITIONS_AHEAD", "7"))
+
+# Индивидуальные размеры пулов.
+# Формат переменной DB_POOL_SIZES: "nutsfarm:1:5,stats:2:20" (имя:min:max)
+db_pool_sizes_env = os.getenv("DB_POOL_SIZES", "")
+DB_POOL_SIZES = {}
+for entry in db_pool_sizes_env.split(","):
+    parts = entry.split(":")
+    if len(parts) == 3:
+        try:
+            DB_POOL_SIZES[parts[0].strip()] = (int(parts[1]), int(parts[2]))
+        except ValueError:
+            pass
+
 # Разрешённые пользователи с указанием отдела.
 # Формат переменной ALLOWED_USERS: "123456789:marketing,987654321:analytics,111111111:admin"
 allowed_users_env = os.getenv("ALLOWED_USERS", "")
@@ -66,9 +220,55 @@ SERVICES_CONFIG = {
 }
 
 # Конфигурация запросов для каждого сервиса.
+# Необязательный параметр cache_ttl задаёт время жизни результата в кэше (в секундах).
+# Параметр kind ("kpi" по умолчанию или "export") задаёт приоритет запроса в очереди отчётов.
+# Параметр pregenerate ("ЧЧ:ММ" в SCHEDULE_TIMEZONE) включает ежедневную подготовку отчёта заранее.
+# Параметр watermark (колонка результата, например id или updated_at) включает выгрузку только новых строк:
+# бот запоминает для каждого пользователя последнее выданное значение колонки.
+# Тип колонки задаётся параметром watermark_type ("bigint" по умолчанию, например "timestamptz").
+# Параметры timeout (в секундах), max_cost и max_rows переопределяют QUERY_TIMEOUT, QUERY_MAX_COST и QUERY_MAX_ROWS.
+# Параметр params – список параметров, которые пользователь вводит перед выполнением запроса
+# (name, label, type: "date"/"int"/"text", необязательные default, min, max, after); в SQL они передаются как $1, $2, ...
+# Запрос выполняется как подготовленный: план переиспользуется соединением для всех пользователей.
+# KPI по активности Nutsfarm читают дневные роллапы из базы статистики (см. RollupWorker).
+# Аналитика чатов за период читает почасовую историю activity_hourly только из партиций нужных дней.
+ACTIVITY_WINDOW_SQL = """SELECT h.chat_id, s.chat_title, s.chat_topic, h.user_id,
+    SUM(h.message_count) AS message_count, SUM(h.total_length) AS total_length
+FROM activity_hourly h
+LEFT JOIN activity_stats s ON s.chat_id = h.chat_id AND s.user_id = h.user_id
+WHERE h.bucket >= date_trunc('hour', now()) - interval '{window}' AND h.bucket < now()
+GROUP BY h.chat_id, s.chat_title, s.chat_topic, h.user_id
+ORDER BY h.chat_id, message_count DESC;"""
+
+# Период отчёта, выбираемый пользователем (по умолчанию – последние 30 дней, конец периода включительно)
+PERIOD_PARAMS = [
+    {"name": "date_from", "label": "Начало периода", "type": "date", "default": "-30d"},
+    {"name": "date_to", "label": "Конец периода", "type": "date", "default": "today", "after": "date_from"},
+]
+
+ACTIVITY_PERIOD_SQL = """SELECT h.chat_id, s.chat_title, s.chat_topic, h.user_id,
+    SUM(h.message_count) AS message_count, SUM(h.total_length) AS total_length
+FROM activity_hourly h
+LEFT JOIN activity_stats s ON s.chat_id = h.chat_id AND s.user_id = h.user_id
+WHERE h.bucket >= $1::date AND h.bucket < $2::date + 1
+GROUP BY h.chat_id, s.chat_title, s.chat_topic, h.user_id
+ORDER BY message_count DESC, h.chat_id, h.user_id
+LIMIT $3;"""
+
+# Имя роллапа активности Nutsfarm в rollup_state
+ROLLUP_NAME = "nutsfarm_daily_active"
+# KPI по роллапам считаются на последний обработанный день (колонка day), а не на current_date:
+# до обработки вчерашнего дня они иначе показывали бы нули. Пока роллапов нет, строк нет
+ROLLUP_DAY_CTE = f"WITH r AS (SELECT last_day AS day FROM rollup_state WHERE name = '{ROLLUP_NAME}')\n"
+
 SERVICE_QUERIES = {
     "telegram_chats": [
-        {"name": "Аналитика телеграм чатов", "callback": "qTGa", "sql": "SELECT * FROM activity_stats;", "db": "analytics_bot", "db_instanse": "analytics_bot"}, 
+        {"name": "Аналитика телеграм чатов", "callback": "qTGa", "sql": "SELECT * FROM activity_stats;", "db": "analytics_bot", "db_instanse": "analytics_bot", "kind": "export"}, 
+        {"name": "Аналитика телеграм чатов за 24 часа", "callback": "qTG1d", "sql": ACTIVITY_WINDOW_SQL.format(window="24 hours"), "db": "stats", "db_instanse": "stats", "kind": "export", "cache_ttl": 300},
+        {"name": "Аналитика телеграм чатов за 7 дней", "callback": "qTG7d", "sql": ACTIVITY_WINDOW_SQL.format(window="7 days"), "db": "stats", "db_instanse": "stats", "kind": "export", "cache_ttl": 900},
+        {"name": "Аналитика телеграм чатов за 30 дней", "callback": "qTG30d", "sql": ACTIVITY_WINDOW_SQL.format(window="30 days"), "db": "stats", "db_instanse": "stats", "kind": "export", "cache_ttl": 1800},
+        {"name": "Топ участников чатов за период", "callback": "qTGp", "sql": ACTIVITY_PERIOD_SQL, "db": "stats", "db_instanse": "stats", "kind": "export", "cache_ttl": 300,
+         "params": PERIOD_PARAMS + [{"name": "limit", "label": "Число строк", "type": "int", "default": 1000, "min": 1, "max": 1000000}]},
     ],
     "union_marketing": [
        
@@ -77,48 +277,49 @@ SERVICE_QUERIES = {
        
     ],
     "nutsfarm_marketing": [
-        {"name": "DAU, WAU, MAU", "callback": "DAU, WAU, MAU", "sql": """SELECT 
-    (SELECT COUNT(*) FROM (SELECT l.user_id FROM user_transaction l WHERE l.created_at >= date_trunc('day', now() - interval '1 day') AND l.created_at < date_trunc('day', now()) GROUP BY l.user_id HAVING COUNT(l.id) >= 1) AS active_users) AS dau,
-    (SELECT COUNT(*) FROM (SELECT l.user_id FROM user_transaction l WHERE l.created_at >= now() - interval '1 week' GROUP BY l.user_id HAVING COUNT(l.id) >= 1) AS active_users) AS wau,
-    (SELECT COUNT(*) FROM (SELECT l.user_id FROM user_transaction l WHERE l.created_at >= now() - interval '30 day' GROUP BY l.user_id HAVING COUNT(l.id) > 1) AS active_users) AS mau""", "db": "nutsfarm", "db_instanse": "nutsfarm"},
-    {"name": "RET_1d, RET_3d, RET_7d, RET_30d", "callback": "RET_1d, RET_3d, RET_7d, RET_30d", "sql": """SELECT
-    (SELECT COUNT(DISTINCT user_id) FROM user_transaction l WHERE l.created_at >= date_trunc('day', now() - interval '1 day') AND l.created_at < date_trunc('day', now())) AS ret_1d,
-    (SELECT COUNT(DISTINCT user_id) FROM user_transaction l WHERE l.created_at >= date_trunc('day', now() - interval '3 day') AND l.created_at < date_trunc('day', now())) AS ret_3d,
-    (SELECT COUNT(DISTINCT user_id) FROM user_transaction l WHERE l.created_at >= date_trunc('day', now() - interval '7 day') AND l.created_at < date_trunc('day', now())) AS ret_7d,
-    (SELECT COUNT(DISTINCT user_id) FROM user_transaction l WHERE l.created_at >= date_trunc('day', now() - interval '30 day') AND l.created_at < date_trunc('day', now())) AS ret_30d
-""", "db": "nutsfarm", "db_instanse": "nutsfarm"},    {"name": "New Users (первичный вход)", "callback": "New Users", "sql": """SELECT COUNT(*) AS new_users
+        {"name": "DAU, WAU, MAU", "callback": "DAU, WAU, MAU", "sql": ROLLUP_DAY_CTE + """SELECT
+    r.day,
+    (SELECT COUNT(*) FROM nutsfarm_daily_active_users d WHERE d.day = r.day) AS dau,
+    (SELECT COUNT(DISTINCT user_id) FROM nutsfarm_daily_active_users d WHERE d.day BETWEEN r.day - 6 AND r.day) AS wau,
+    (SELECT COUNT(*) FROM (SELECT user_id FROM nutsfarm_daily_active_users d WHERE d.day BETWEEN r.day - 29 AND r.day GROUP BY user_id HAVING SUM(tx_count) > 1) AS active_users) AS mau
+FROM r""", "db": "stats", "db_instanse": "stats", "cache_ttl": 600},
+    {"name": "RET_1d, RET_3d, RET_7d, RET_30d", "callback": "RET_1d, RET_3d, RET_7d, RET_30d", "sql": ROLLUP_DAY_CTE + """SELECT
+    r.day,
+    (SELECT COUNT(DISTINCT user_id) FROM nutsfarm_daily_active_users d WHERE d.day = r.day) AS ret_1d,
+    (SELECT COUNT(DISTINCT user_id) FROM nutsfarm_daily_active_users d WHERE d.day BETWEEN r.day - 2 AND r.day) AS ret_3d,
+    (SELECT COUNT(DISTINCT user_id) FROM nutsfarm_daily_active_users d WHERE d.day BETWEEN r.day - 6 AND r.day) AS ret_7d,
+    (SELECT COUNT(DISTINCT user_id) FROM nutsfarm_daily_active_users d WHERE d.day BETWEEN r.day - 29 AND r.day) AS ret_30d
+FROM r
+""", "db": "stats", "db_instanse": "stats", "cache_ttl": 600},    {"name": "New Users (первичный вход)", "callback": "New Users", "sql": """SELECT COUNT(*) AS new_users
 FROM entity_user e
 WHERE e.created_at >= date_trunc('day', now() - interval '1 day')
-""", "db": "nutsfarm", "db_instanse": "nutsfarm"},     {"name": "Revenue, ARPU, ARPPU", "callback": "Revenue, ARPU, ARPPU", "sql": """SELECT 
+""", "db": "nutsfarm", "db_instanse": "nutsfarm", "cache_ttl": 300},     {"name": "Revenue, ARPU, ARPPU", "callback": "Revenue, ARPU, ARPPU", "sql": """SELECT 
     (SELECT SUM(amount) FROM payment_transactions WHERE created_at >= now() - interval '1 month') AS revenue,
     (SELECT SUM(amount) / COUNT(DISTINCT user_id) FROM payment_transactions WHERE created_at >= now() - interval '1 month') AS arpu,
     (SELECT SUM(amount) / COUNT(DISTINCT CASE WHEN amount > 0 THEN user_id END) FROM payment_transactions WHERE created_at >= now() - interval '1 month') AS arppu
-""", "db": "nutsfarm", "db_instanse": "nutsfarm"},      {"name": "Churn Rate (_1d, _3d, _7d, _30d)", "callback": "Churn Rate (_1d, _3d, _7d, _30d)", "sql": """WITH user_activity AS (
-    SELECT
-        user_id,
-        MAX(CASE WHEN created_at >= date_trunc('day', now() - interval '1 day') THEN 1 ELSE 0 END) AS active_1d,
-        MAX(CASE WHEN created_at >= date_trunc('day', now() - interval '3 day') THEN 1 ELSE 0 END) AS active_3d,
-        MAX(CASE WHEN created_at >= date_trunc('day', now() - interval '7 day') THEN 1 ELSE 0 END) AS active_7d,
-        MAX(CASE WHEN created_at >= date_trunc('day', now() - interval '30 day') THEN 1 ELSE 0 END) AS active_30d
-    FROM
-        user_transaction
-    GROUP BY
-        user_id
-)
-SELECT
+""", "db": "nutsfarm", "db_instanse": "nutsfarm", "cache_ttl": 300},
+    {"name": "Revenue, ARPU, ARPPU за период", "callback": "Revenue period", "sql": """SELECT
+    SUM(amount) AS revenue,
+    SUM(amount) / NULLIF(COUNT(DISTINCT user_id), 0) AS arpu,
+    SUM(amount) / NULLIF(COUNT(DISTINCT CASE WHEN amount > 0 THEN user_id END), 0) AS arppu
+FROM payment_transactions
+WHERE created_at >= $1::date AND created_at < $2::date + 1
+""", "db": "nutsfarm", "db_instanse": "nutsfarm", "cache_ttl": 300, "params": PERIOD_PARAMS},           {"name": "Churn Rate (_1d, _3d, _7d, _30d)", "callback": "Churn Rate (_1d, _3d, _7d, _30d)", "sql": ROLLUP_DAY_CTE + """SELECT
+    r.day,
     -- Чурн по 1 дню
-    COUNT(CASE WHEN active_1d = 0 THEN 1 END) * 1.0 / COUNT(user_id) AS churn_1d,
+    COUNT(a.user_id) FILTER (WHERE a.last_day < r.day) * 1.0 / NULLIF(COUNT(a.user_id), 0) AS churn_1d,
 
     -- Чурн по 3 дням
-    COUNT(CASE WHEN active_3d = 0 THEN 1 END) * 1.0 / COUNT(user_id) AS churn_3d,
+    COUNT(a.user_id) FILTER (WHERE a.last_day < r.day - 2) * 1.0 / NULLIF(COUNT(a.user_id), 0) AS churn_3d,
 
     -- Чурн по 7 дням
-    COUNT(CASE WHEN active_7d = 0 THEN 1 END) * 1.0 / COUNT(user_id) AS churn_7d,
+    COUNT(a.user_id) FILTER (WHERE a.last_day < r.day - 6) * 1.0 / NULLIF(COUNT(a.user_id), 0) AS churn_7d,
 
     -- Чурн по 30 дням
-    COUNT(CASE WHEN active_30d = 0 THEN 1 END) * 1.0 / COUNT(user_id) AS churn_30d
-FROM
-    user_activity;""", "db": "nutsfarm", "db_instanse": "nutsfarm"},
+    COUNT(a.user_id) FILTER (WHERE a.last_day < r.day - 29) * 1.0 / NULLIF(COUNT(a.user_id), 0) AS churn_30d
+FROM r
+LEFT JOIN nutsfarm_user_activity a ON true
+GROUP BY r.day;""", "db": "stats", "db_instanse": "stats", "cache_ttl": 1800, "timeout": 60},
     ],
     "analytics_nuts": [
         {"name": "Выгрузка всех пользователей", "callback": "qX", "sql": """WITH user_data AS (
@@ -171,7 +372,8 @@ FROM
         tasks_count,
         current_streak,
         has_ton_wallet
-    FROM user_data;""", "db": "nutsfarm", "db_instanse": "nutsfarm"},
+    FROM user_data;""", "db": "nutsfarm", "db_instanse": "nutsfarm", "kind": "export", "pregenerate": "04:00",
+         "watermark": "id", "timeout": 3600, "max_cost": 50000000},
         {"name": "Выгрузка активированности юзеров", "callback": "qW", 
          "sql": """WITH lessons AS (
     SELECT user_id, COUNT(DISTINCT lesson_id) AS lessons_passed
@@ -233,374 +435,3408 @@ LEFT JOIN current_nut cn ON cn.user_id = eu.id
 LEFT JOIN tasks t ON t.user_id = eu.id
 ORDER BY eu.id;
 """, 
-         "db": "nutsfarm", "db_instanse": "nutsfarm"}
+         "db": "nutsfarm", "db_instanse": "nutsfarm", "kind": "export", "pregenerate": "04:30",
+         "timeout": 3600, "max_cost": 50000000}
     ]
 }
 
-# Глобальная переменная для отслеживания активности пользователей в приватных чатах.
-ACTIVITY_STATS = {}
+# Статистика активности пользователей (ActivityStatsStore), создаётся в main()
+ACTIVITY_STATS = None
+
+# Реестр сервисов и запросов, собирается в main()
+SERVICE_REGISTRY = None
+# Реестр пулов соединений, создаётся в main()
+DB_POOLS = None
+# Буфер статистики групповых чатов, создаётся в main()
+ACTIVITY_BUFFER = None
+# Пул для тяжёлых этапов формирования отчётов, создаётся в main()
+REPORT_EXECUTOR = None
+# Кэш результатов запросов, создаётся в main()
+RESULT_CACHE = None
+# Кэш file_id отправленных отчётов, создаётся в main()
+FILE_ID_CACHE = None
+# Фоновое обновление роллапов, создаётся в main()
+ROLLUP_WORKER = None
+# Очередь отчётов, создаётся в main()
+REPORT_SCHEDULER = None
+# Планировщик фоновых отчётов и подписок, создаётся в main()
+REPORT_PLANNER = None
+# HTTP-эндпоинт метрик, создаётся в main()
+METRICS_SERVER = None
+# Пересылка отмены заданий между репликами, создаётся в main()
+CANCEL_RELAY = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # ----------------------------
-# Модуль миграций
+# Метрики
 # ----------------------------
 
-def generate_csv(data) -> io.BytesIO:
-    output = io.StringIO()
-    if data:
-        # Преобразуем первую запись в dict, чтобы получить заголовки
-        headers = list(dict(data[0]).keys())
-        writer = csv.DictWriter(output, fieldnames=headers)
-        writer.writeheader()
-        for record in data:
-            # Преобразуем каждую запись в dict перед записью
-            writer.writerow(dict(record))
-    else:
-        output.write("Нет данных для отображения")
-    csv_bytes = io.BytesIO(output.getvalue().encode("utf-8"))
-    csv_bytes.seek(0)
-    return csv_bytes
-
-def compress_excel_to_zip(excel_bytes_io: io.BytesIO, zip_filename: str = "report.zip") -> io.BytesIO:
-    # Получаем имя Excel файла, если оно установлено, иначе используем "report.xlsx"
-    excel_filename = getattr(excel_bytes_io, "name", "report.xlsx")
-    zip_bytes_io = io.BytesIO()
-    # Используем метод ZIP_LZMA с максимальным уровнем сжатия (compresslevel=9)
-    with zipfile.ZipFile(zip_bytes_io, mode="w", compression=zipfile.ZIP_LZMA, compresslevel=9) as zf:
-        zf.writestr(excel_filename, excel_bytes_io.getvalue())
-    zip_bytes_io.seek(0)
-    return zip_bytes_io
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = tuple(4 ** power for power in range(3, 15))
 
-async def init_stats_table():
+# Имя метрики -> (тип, описание, единица измерения, границы корзин гистограммы)
+METRIC_DEFINITIONS = {
+    "report_queue_wait_seconds": ("histogram", "Ожидание отчёта в очереди", "seconds", DURATION_BUCKETS),
+    "report_duration_seconds": ("histogram", "Полное время выполнения отчёта", "seconds", DURATION_BUCKETS),
+    "report_query_seconds": ("histogram", "Выполнение запроса и запись результата в spool-файл", "seconds", DURATION_BUCKETS),
+    "report_rows": ("histogram", "Число строк в результате запроса", "rows", SIZE_BUCKETS),
+    "report_spool_bytes": ("histogram", "Размер spool-файла результата", "bytes", SIZE_BUCKETS),
+    "report_encode_seconds": ("histogram", "Кодирование файла отчёта вместе со сжатием", "seconds", DURATION_BUCKETS),
+    "report_file_bytes": ("histogram", "Размер файла (части) отчёта", "bytes", SIZE_BUCKETS),
+    "report_upload_seconds": ("histogram", "Загрузка файла (части) отчёта в Telegram", "seconds", DURATION_BUCKETS),
+    "report_cache_requests_total": ("counter", "Обращения к кэшу результатов запросов", None, None),
+    "report_file_id_sends_total": ("counter", "Отчёты, отправленные по сохранённому file_id", None, None),
+    "report_errors_total": ("counter", "Ошибки формирования отчётов по этапам", None, None),
+    "report_preflight_total": ("counter", "Решения предварительной оценки запросов (ok, background, rejected)", None, None),
+    "dashboard_duration_seconds": ("histogram", "Формирование сводки всех отчётов сервиса", "seconds", DURATION_BUCKETS),
+    "activity_track_seconds": ("histogram", "Учёт сообщения в статистике активности", "seconds", DURATION_BUCKETS),
+    "activity_flush_seconds": ("histogram", "Сброс буфера статистики чатов в БД", "seconds", DURATION_BUCKETS),
+    "activity_flush_entries": ("histogram", "Число записей в сброшенном буфере статистики", "rows", SIZE_BUCKETS),
+    "activity_flush_errors_total": ("counter", "Неудачные сбросы буфера статистики чатов", None, None),
+    "activity_buffer_entries": ("gauge", "Записей в буфере статистики чатов", None, None),
+    "db_replica_lag_seconds": ("gauge", "Отставание реплики для чтения (-1 – реплика недоступна)", None, None),
+    "db_route_total": ("counter", "Запросы на чтение по месту выполнения (replica, primary)", None, None),
+}
+
+
+class MetricSeries:
     """
-    Инициализация таблицы для статистики сообщений.
-    Таблица создаётся с дополнительными полями для названия чата и топика (если он есть).
+    Гистограмма одной метрики с конкретными метками: счётчики по корзинам
+    и последние window замеров для перцентилей.
     """
-    conn = await asyncpg.connect(STATS_DB_URL)
-    try:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS activity_stats (
-                chat_id BIGINT,
-                user_id BIGINT,
-                chat_title TEXT,
-                chat_topic TEXT,
-                message_count INTEGER,
-                total_length INTEGER,
-                PRIMARY KEY (chat_id, user_id)
-            );
-        """)
-        logger.info("Таблица activity_stats успешно инициализирована.")
-    finally:
-        await conn.close()
 
-async def run_migrations():
+    __slots__ = ("count", "total", "buckets", "recent")
+
+    def __init__(self, bucket_count: int, window: int):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * bucket_count
+        self.recent = deque(maxlen=window)
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    parts = []
+    for name, value in labels + extra:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
     """
-    Запускает все миграции для БД.
-    Здесь можно добавить и другие миграционные шаги.
+    Метрики горячих путей бота: гистограммы (время, строки, байты), счётчики и показатели.
+    Отдаются в формате Prometheus (render) и в виде перцентилей последних замеров (/perf).
     """
-    await init_stats_table()
-    logger.info("Все миграции успешно выполнены.")
 
-# ----------------------------
-# Вспомогательные функции
-# ----------------------------
+    def __init__(self, definitions: dict, window: int):
+        self._definitions = definitions
+        self._window = window
+        self._values = {name: {} for name in definitions}
 
-async def fetch_data(query: str, db_url: str):
-    conn = await asyncpg.connect(db_url)
-    try:
-        data = await conn.fetch(query)
-    finally:
-        await conn.close()
-    return data
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
 
-def generate_excel(data) -> io.BytesIO:
-    max_rows = 1048576
-    wb = Workbook(write_only=True)
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._definitions[name][3]
+        series_by_labels = self._values[name]
+        key = self._key(labels)
+        series = series_by_labels.get(key)
+        if series is None:
+            series = series_by_labels[key] = MetricSeries(len(buckets), self._window)
+        series.count += 1
+        series.total += value
+        index = bisect.bisect_left(buckets, value)
+        if index < len(buckets):
+            series.buckets[index] += 1
+        series.recent.append(value)
 
-    if not data:
-        ws = wb.create_sheet("Sheet1")
-        ws.append(["Нет данных для отображения"])
-    else:
-        headers = list(data[0].keys())
-        chunk_size = max_rows - 1  
-        for i in range(0, len(data), chunk_size):
-            sheet_title = f"Sheet{i//chunk_size + 1}"
-            ws = wb.create_sheet(title=sheet_title)
-            ws.append(headers)
-            for record in data[i:i + chunk_size]:
-                ws.append([record.get(header) for header in headers])
-    
-    excel_io = io.BytesIO()
-    wb.save(excel_io)
-    excel_io.seek(0)
-    return excel_io
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(labels)
+        series_by_labels = self._values[name]
+        series_by_labels[key] = series_by_labels.get(key, 0) + value
 
-def get_user_department(user_id: int):
-    return ALLOWED_USERS.get(user_id)
+    def set(self, name: str, value: float, **labels):
+        self._values[name][self._key(labels)] = value
 
-def get_services_for_user(dept: str):
-    services = []
-    if dept == "admin":
-        for _, value in SERVICES_CONFIG.items():
-            for elem in value:
-                services.append(elem)
-    else:
-        services = SERVICES_CONFIG.get(dept, [])
-    return services
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        # Замер учитывается только для успешно завершённого блока, ошибки считаются отдельно
+        started = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - started, **labels)
 
-def get_reply_keyboard_for_services(dept: str):
-    services = get_services_for_user(dept)
-    # Формируем список рядов кнопок – каждый ряд содержит одну кнопку
-    buttons = [[KeyboardButton(text=service["name"])] for service in services]
-    return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+    def render(self) -> str:
+        lines = []
+        for name, (kind, description, _, buckets) in self._definitions.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in self._values[name].items():
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value.buckets):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{_format_labels(key)} {value.total}")
+                lines.append(f"{name}_count{_format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
 
-def get_service_by_name(dept: str, name: str):
-    services = get_services_for_user(dept)
-    for service in services:
-        if service["name"] == name:
-            return service
-    return None
-
-def get_service_group(service_id: str):
-    for group, services in SERVICES_CONFIG.items():
-        for service in services:
-            if service["id"] == service_id:
-                return group
-    return None
+    def percentiles(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Перцентили последних замеров каждой гистограммы: [(имя, метки, единица, число замеров, [значения])].
+        """
+        report = []
+        for name, (kind, _, unit, _) in self._definitions.items():
+            if kind != "histogram":
+                continue
+            for key, series in self._values[name].items():
+                if not series.recent:
+                    continue
+                values = sorted(series.recent)
+                report.append((name, key, unit, len(values),
+                               [values[min(int(q * len(values)), len(values) - 1)] for q in quantiles]))
+        return report
 
-def get_inline_keyboard_for_service(service_id: str):
-    queries = SERVICE_QUERIES.get(service_id, [])
-    # Создаем InlineKeyboardMarkup с обязательным полем inline_keyboard
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-    for query in queries:
-        callback_data = f"{service_id}:{query['callback']}"
-        keyboard.inline_keyboard.append([InlineKeyboardButton(text=query["name"], callback_data=callback_data)])
-    return keyboard
+    def counters(self):
+        """
+        Текущие значения счётчиков и показателей: [(имя, метки, значение)].
+        """
+        return [(name, key, value)
+                for name, (kind, _, _, _) in self._definitions.items() if kind != "histogram"
+                for key, value in self._values[name].items()]
+
+
+class MetricsServer:
+    """
+    Локальный HTTP-эндпоинт /metrics для сбора метрик Prometheus.
+    """
+
+    def __init__(self, metrics: Metrics, host: str, port: int):
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self._metrics.render(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        if not self._port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self._host, self._port).start()
+        logger.info("Метрики доступны на http://%s:%s/metrics", self._host, self._port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# Метрики не зависят от внешних ресурсов и доступны с момента импорта
+METRICS = Metrics(METRIC_DEFINITIONS, METRICS_WINDOW)
 
 # ----------------------------
-# Обновление статистики в БД (с chat_title и chat_topic)
+# Пулы соединений с БД
 # ----------------------------
 
-async def update_activity_stats_in_db(chat_id: int, user_id: int, chat_title: str, chat_topic: str, msg_length: int):
-    """
-    Обновляет статистику активности пользователя в конкретном чате в БД.
-    Если запись существует (по паре chat_id и user_id), то увеличивает счетчик и суммарную длину,
-    а также обновляет название чата и топик.
+# Отставание реплики: время с последней применённой транзакции, если полученный WAL ещё не применён.
+# Когда весь полученный WAL применён, реплика актуальна, даже если на основной БД давно не было записи
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END::float8
+"""
+# Ограничение времени подключения и проверки реплики
+REPLICA_CHECK_TIMEOUT = 10
+
+
+class ReplicaPool:
+    """Реплика для чтения: пул соединений и результат последней проверки."""
+
+    __slots__ = ("name", "url", "pool", "lag", "healthy")
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.pool = None
+        self.lag = None
+        self.healthy = False
+
+    def usable(self) -> bool:
+        return self.healthy and self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG
+
+    def load(self) -> float:
+        # Доля занятых соединений пула
+        return (self.pool.get_size() - self.pool.get_idle_size()) / self.pool.get_max_size()
+
+
+class PoolRegistry:
     """
-    query = """
-    INSERT INTO activity_stats (chat_id, user_id, chat_title, chat_topic, message_count, total_length)
-    VALUES ($1, $2, $3, $4, 1, $5)
-    ON CONFLICT (chat_id, user_id) DO UPDATE
-    SET message_count = activity_stats.message_count + 1,
-        total_length = activity_stats.total_length + $5,
-        chat_title = EXCLUDED.chat_title,
-        chat_topic = EXCLUDED.chat_topic;
+    Реестр пулов соединений asyncpg.
+    Для каждой настроенной базы пул создаётся лениво при первом обращении
+    и затем переиспользуется всеми хэндлерами. Запросы только на чтение распределяются
+    по репликам базы, если они настроены (см. acquire).
     """
-    conn = await asyncpg.connect(STATS_DB_URL)
-    try:
-        await conn.execute(query, chat_id, user_id, chat_title, chat_topic, msg_length)
-    finally:
-        await conn.close()
+
+    def __init__(self, urls: dict, sizes: dict = None, replicas: dict = None):
+        self._urls = {name: url for name, url in urls.items() if url}
+        self._sizes = sizes or {}
+        self._pools = {}
+        self._locks = {}
+        self._health_task = None
+        self._replicas = {
+            name: [ReplicaPool(f"{name}/replica{number}", url) for number, url in enumerate(replica_urls, 1)]
+            for name, replica_urls in (replicas or {}).items() if name in self._urls and replica_urls
+        }
+        self._replicas_checked = set()
+        self._replica_task = None
+        self._turn = itertools.count()
+
+    def has(self, name: str) -> bool:
+        return name in self._urls
+
+    async def _create_pool(self, name: str, url: str, label: str) -> asyncpg.Pool:
+        # Пулы реплик получают те же размеры, что и пул основной БД
+        min_size, max_size = self._sizes.get(name, (DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE))
+        pool = await asyncpg.create_pool(url, min_size=min_size, max_size=max_size,
+                                         statement_cache_size=DB_STATEMENT_CACHE_SIZE)
+        logger.info("Создан пул соединений %s (min=%s, max=%s)", label, min_size, max_size)
+        return pool
+
+    async def get(self, name: str) -> asyncpg.Pool:
+        pool = self._pools.get(name)
+        if pool is not None:
+            return pool
+        if name not in self._urls:
+            raise KeyError(f"Нет настроенной БД: {name}")
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = await self._create_pool(name, self._urls[name], name)
+        return pool
+
+    async def connect(self, name: str) -> asyncpg.Connection:
+        """
+        Отдельное соединение с БД name вне пула (для долгоживущих сессионных блокировок).
+        Закрывать его должен вызывающий.
+        """
+        if name not in self._urls:
+            raise KeyError(f"Нет настроенной БД: {name}")
+        return await asyncpg.connect(self._urls[name], statement_cache_size=DB_STATEMENT_CACHE_SIZE)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, name: str, readonly: bool = False):
+        """
+        Соединение с БД name. Запрос только на чтение (readonly=True) при настроенных репликах
+        выполняется на наименее загруженной реплике с отставанием не больше DB_REPLICA_MAX_LAG.
+        Если таких нет или к реплике не удалось подключиться, запрос выполняется на основной БД.
+        """
+        if readonly and name in self._replicas:
+            await self._ensure_replicas_checked(name)
+            while (replica := self._pick_replica(name)) is not None:
+                try:
+                    conn = await replica.pool.acquire()
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                    # До следующей проверки реплика не получает запросы
+                    logger.warning("Реплика %s недоступна, запрос переключается: %s", replica.name, e)
+                    replica.healthy = False
+                    METRICS.set("db_replica_lag_seconds", -1, db=name, replica=replica.name)
+                    continue
+                METRICS.inc("db_route_total", db=name, target="replica")
+                try:
+                    yield conn
+                finally:
+                    await replica.pool.release(conn)
+                return
+            METRICS.inc("db_route_total", db=name, target="primary")
+        pool = await self.get(name)
+        async with pool.acquire() as conn:
+            yield conn
+
+    def _pick_replica(self, name: str):
+        candidates = [replica for replica in self._replicas[name] if replica.usable()]
+        if not candidates:
+            return None
+        # При равной загрузке реплики выбираются по очереди
+        start = next(self._turn) % len(candidates)
+        return min(candidates[start:] + candidates[:start], key=ReplicaPool.load)
+
+    async def _ensure_replicas_checked(self, name: str):
+        # До первой проверки отставание реплик неизвестно
+        if name in self._replicas_checked:
+            return
+        async with self._locks.setdefault(f"{name}/replicas", asyncio.Lock()):
+            if name not in self._replicas_checked:
+                await asyncio.gather(*(self._check_replica(name, replica) for replica in self._replicas[name]))
+                self._replicas_checked.add(name)
+
+    async def _check_replica(self, name: str, replica: ReplicaPool):
+        usable = replica.usable()
+        try:
+            if replica.pool is None:
+                replica.pool = await asyncio.wait_for(
+                    self._create_pool(name, replica.url, replica.name), REPLICA_CHECK_TIMEOUT
+                )
+            async with replica.pool.acquire(timeout=REPLICA_CHECK_TIMEOUT) as conn:
+                replica.lag = await conn.fetchval(REPLICA_LAG_SQL, timeout=REPLICA_CHECK_TIMEOUT)
+            healthy = True
+        except Exception as e:
+            if replica.healthy or name not in self._replicas_checked:
+                logger.error("Реплика %s не прошла проверку: %s", replica.name, e)
+            if replica.pool is not None:
+                await replica.pool.expire_connections()
+            healthy = False
+        replica.healthy = healthy
+        # В журнал попадают только переходы между состояниями, а не каждая проверка
+        if healthy and not replica.usable() and (usable or name not in self._replicas_checked):
+            logger.warning("Реплика %s отстаёт на %.1f с и не получает запросы", replica.name, replica.lag)
+        elif replica.usable() and not usable and name in self._replicas_checked:
+            logger.info("Реплика %s снова получает запросы (отставание %.1f с)", replica.name, replica.lag)
+        METRICS.set("db_replica_lag_seconds", replica.lag if healthy else -1, db=name, replica=replica.name)
+
+    async def check_replicas(self):
+        await asyncio.gather(*(self._check_replica(name, replica)
+                               for name, replicas in self._replicas.items() for replica in replicas))
+        self._replicas_checked.update(self._replicas)
+
+    async def check_health(self):
+        """
+        Проверяет каждый созданный пул запросом SELECT 1.
+        При ошибке соединения пула помечаются устаревшими и будут пересозданы.
+        """
+        for name, pool in list(self._pools.items()):
+            try:
+                async with pool.acquire(timeout=10) as conn:
+                    await conn.fetchval("SELECT 1")
+            except Exception as e:
+                logger.error("Пул %s не прошёл проверку здоровья: %s", name, e)
+                await pool.expire_connections()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(DB_POOL_HEALTH_INTERVAL)
+            await self.check_health()
+
+    async def _replica_loop(self):
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(DB_REPLICA_CHECK_INTERVAL)
+
+    def start_health_checks(self):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+        if self._replicas and self._replica_task is None:
+            self._replica_task = asyncio.create_task(self._replica_loop())
+
+    async def close(self):
+        """
+        Останавливает проверки здоровья и корректно закрывает все пулы.
+        Если пул не закрылся за отведённое время, соединения разрываются принудительно.
+        """
+        for task in (self._health_task, self._replica_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self._health_task = self._replica_task = None
+        pools = list(self._pools.items())
+        pools += [(replica.name, replica.pool) for replicas in self._replicas.values()
+                  for replica in replicas if replica.pool is not None]
+        for name, pool in pools:
+            try:
+                await asyncio.wait_for(pool.close(), timeout=10)
+            except Exception as e:
+                logger.error("Пул %s не закрылся корректно: %s", name, e)
+                pool.terminate()
+        self._pools.clear()
+        for replicas in self._replicas.values():
+            for replica in replicas:
+                replica.pool = None
+        self._replicas_checked.clear()
+        logger.info("Пулы соединений закрыты.")
 
 # ----------------------------
-# FSM для выбора сервиса
+# Пул для формирования отчётов
 # ----------------------------
 
-class ServiceSelection(StatesGroup):
-    waiting_for_service = State()
+class ReportExecutor:
+    """
+    Пул для синхронных CPU-ёмких этапов отчёта (кодирование, сжатие),
+    чтобы они не блокировали цикл событий бота.
+    В режиме "process" функции и их аргументы должны сериализоваться через pickle,
+    поэтому этапы работают с путями к файлам, а не с объектами в памяти.
+    """
+
+    def __init__(self, kind: str = "thread", workers: int = 4):
+        if kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        elif kind == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report")
+        else:
+            raise ValueError(f"Неизвестный тип пула отчётов: {kind}")
+        self.kind = kind
+        logger.info("Пул отчётов: %s, воркеров: %s", kind, workers)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
 
 # ----------------------------
-# Хэндлеры
+# Кэш результатов запросов
 # ----------------------------
 
-async def start_handler(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    if user_id not in ALLOWED_USERS:
-        await message.answer("У вас нет доступа к этому боту.")
-        logger.warning("Попытка доступа неавторизованного пользователя: %s", user_id)
-        return
+class CachedResult:
+    """
+    Результат запроса, сохранённый в spool-файле.
+    Файл удаляется, когда запись вытеснена из кэша и ни один отчёт его больше не читает.
+    """
 
-    dept = get_user_department(user_id)
-    keyboard = get_reply_keyboard_for_services(dept)
-    await message.answer("Добро пожаловать!\nВыберите сервис:", reply_markup=keyboard)
-    logger.info("Пользователь %s (отдел %s) запустил бота", user_id, dept)
-    # Устанавливаем состояние для выбора сервиса
-    await state.set_state(ServiceSelection.waiting_for_service)
+    __slots__ = ("path", "columns", "rows_count", "digest", "size", "expires_at", "refs", "evicted", "preloaded")
 
-async def service_selection_handler(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    dept = get_user_department(user_id)
-    service = get_service_by_name(dept, message.text.strip())
-    if not service:
-        await message.answer("Неизвестный сервис. Пожалуйста, выберите сервис с клавиатуры.")
-        return
-    inline_kb = get_inline_keyboard_for_service(service["id"])
-    await message.answer(f"Сервис «{service['name']}». Выберите запрос:", reply_markup=inline_kb)
-    logger.info("Пользователь %s выбрал сервис %s", user_id, service["name"])
-    # Сбрасываем состояние после выбора сервиса
-    await state.clear()
-
-def compress_csv_to_zip(csv_bytes_io: io.BytesIO, zip_filename: str = "report.zip") -> io.BytesIO:
-    # Получаем имя CSV-файла, если оно задано, иначе используем дефолтное
-    csv_filename = getattr(csv_bytes_io, "name", "report.csv")
-    zip_bytes_io = io.BytesIO()
-    with zipfile.ZipFile(zip_bytes_io, mode="w", compression=zipfile.ZIP_LZMA, compresslevel=9) as zf:
-        zf.writestr(csv_filename, csv_bytes_io.getvalue())
-    zip_bytes_io.seek(0)
-    # Устанавливаем имя для zip-архива
-    zip_bytes_io.name = zip_filename
-    return zip_bytes_io
+    def __init__(self, path: str, columns: list, rows_count: int, digest: str):
+        self.path = path
+        self.columns = columns
+        self.rows_count = rows_count
+        self.digest = digest
+        self.size = os.path.getsize(path)
+        self.expires_at = 0.0
+        self.refs = 0
+        self.evicted = False
+        self.preloaded = False
 
-async def query_callback_handler(callback: types.CallbackQuery, state: FSMContext):
-    user_id = callback.from_user.id
-    try:
-        service_id, query_key = callback.data.split(":", 1)
-    except ValueError:
-        await callback.answer("Неверные данные запроса.")
-        return
+    def release(self):
+        self.refs -= 1
+        self._remove_if_unused()
 
-    queries = SERVICE_QUERIES.get(service_id, [])
-    query_config = None
-    for q in queries:
-        if q["callback"] == query_key:
-            query_config = q
-            break
+    def evict(self):
+        self.evicted = True
+        self._remove_if_unused()
 
-    if not query_config:
-        await callback.answer("Запрос не найден.")
-        logger.warning("Запрос не найден для callback data: %s", callback.data)
-        return
+    def _remove_if_unused(self):
+        if self.evicted and self.refs <= 0:
+            with contextlib.suppress(OSError):
+                os.remove(self.path)
 
-    await callback.answer("Обработка запроса...")
 
-    # Выбор экземпляра БД по параметру из запроса
-    db_instance = query_config.get("db_instanse")
-    if not db_instance:
-        await callback.message.answer("Запрос не настроен: не указан экземпляр БД.")
-        logger.error("Нет параметра db_instanse для запроса %s", query_config["name"])
-        return
+class _Flight:
+    """Выполняющийся запрос, который ожидают один или несколько отчётов."""
 
-    db_url = DATABASE_URLS.get(db_instance)
-    if not db_url:
-        await callback.message.answer("Нет настроенной базы данных для данного запроса.")
-        logger.error("Нет БД для db_instanse: %s", db_instance)
-        return
+    __slots__ = ("task", "waiters")
 
-    try:
-        data_records = await fetch_data(query_config["sql"], db_url)
-        logger.info("Данные успешно получены для запроса %s сервиса %s пользователем %s",
-                    query_config["name"], service_id, user_id)
-    except Exception as e:
-        logger.error("Ошибка при выполнении запроса: %s", e)
-        await callback.message.answer("Ошибка при выполнении запроса к базе данных.")
-        return
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
 
-    await callback.message.answer("Формирую отчет, подождите...")
 
-    try:
-        csv_file = generate_csv(data_records)
-        csv_file.name = f"{service_id}_{query_key}.csv"
-    except Exception as e:
-        logger.error("Ошибка при генерации CSV-файла: %s", e)
-        await callback.message.answer("Ошибка при генерации CSV файла.")
-        return
+class ResultCache:
+    """
+    TTL-кэш результатов запросов с ограничением по объёму и вытеснением LRU.
+    Одновременные одинаковые запросы объединяются: выполняется один запрос к БД,
+    а его результат получают все ожидающие.
+    """
 
-    # Пороговый размер для сжатия (например, 50 МБ)
-    THRESHOLD_SIZE = 50 * 1024 * 1024  
-    if len(csv_file.getvalue()) > THRESHOLD_SIZE:
-        compressed_file = compress_csv_to_zip(csv_file, zip_filename=f"{service_id}_{query_key}.zip")
-        file_to_send = compressed_file
-    else:
-        file_to_send = csv_file
+    def __init__(self, max_bytes: int, directory: str = None, preload_max_bytes: int = 0):
+        self._max_bytes = max_bytes
+        self._preload_max_bytes = preload_max_bytes
+        self._preload_size = 0
+        self._directory = tempfile.mkdtemp(prefix="report_cache_", dir=directory)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._inflight = {}
 
-    try:
-        os.makedirs("docs", exist_ok=True)
-        file_path = os.path.join("docs", file_to_send.name)
-        with open(file_path, "wb") as f:
-            f.write(file_to_send.getvalue())
-        fs_input_file = FSInputFile(file_path)
-        await callback.message.answer_document(
-            document=fs_input_file,
-            caption=f"Отчет: {query_config['name']}"
-        )
-        logger.info("CSV-файл отправлен пользователю %s", user_id)
-    except Exception as e:
-        logger.error("Ошибка при отправке файла: %s", e)
-        await callback.message.answer("Ошибка при отправке файла.")
-    await state.set_state(ServiceSelection.waiting_for_service)
+    def has(self, key) -> bool:
+        """
+        Есть ли по ключу актуальный результат или он уже загружается (новый запрос к БД не понадобится).
+        """
+        entry = self._entries.get(key)
+        return key in self._inflight or (entry is not None and entry.expires_at > time.monotonic())
+
+    @contextlib.asynccontextmanager
+    async def use(self, key, ttl: float, loader, preloaded: bool = False):
+        """
+        Отдаёт результат по ключу key, при необходимости загружая его через loader(path).
+        loader должен записать spool-файл по пути path и вернуть (columns, rows_count, digest).
+        Пока блок with не завершён, spool-файл результата не будет удалён.
+        Новый результат с preloaded=True учитывается в бюджете заранее подготовленных результатов.
+        """
+        result = await self._acquire(key, ttl, loader, preloaded)
+        try:
+            yield result
+        finally:
+            result.release()
 
+    async def _acquire(self, key, ttl: float, loader, preloaded: bool = False) -> CachedResult:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                entry.refs += 1
+                METRICS.inc("report_cache_requests_total", result="hit")
+                return entry
+            self._remove(key)
 
-async def track_activity(message: types.Message):
-    if not message.from_user:
-        return
-    user_id = message.from_user.id
-    text = message.text or ""
-    stats = ACTIVITY_STATS.get(user_id, {"count": 0, "total_length": 0})
-    stats["count"] += 1
-    stats["total_length"] += len(text)
-    ACTIVITY_STATS[user_id] = stats
-
-    # Если сообщение в групповом чате – обновляем статистику в БД,
-    # передавая также название чата и топик (если есть)
-    if message.chat.type in ["group", "supergroup"]:
-        chat_title = message.chat.title if hasattr(message.chat, "title") else ""
-        chat_topic = getattr(message.chat, "topic", None)
+        flight = self._inflight.get(key)
+        METRICS.inc("report_cache_requests_total", result="miss" if flight is None else "joined")
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.create_task(self._load(key, ttl, loader, flight, preloaded))
+            self._inflight[key] = flight
+        flight.waiters += 1
         try:
-            await update_activity_stats_in_db(message.chat.id, user_id, chat_title, chat_topic, len(text))
-        except Exception as e:
-            logger.error("Ошибка при обновлении статистики в БД: %s", e)
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.task.done():
+                # Результат уже был зарезервирован и за этим ожидающим
+                if not flight.task.cancelled() and flight.task.exception() is None:
+                    flight.task.result().release()
+            elif flight.waiters == 0:
+                # Результат больше никому не нужен – отменяем запрос к БД
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+                flight.task.cancel()
+            raise
 
-async def my_stats_handler(message: types.Message):
-    user_id = message.from_user.id
-    stats = ACTIVITY_STATS.get(user_id, {"count": 0, "total_length": 0})
-    count = stats["count"]
-    avg_length = stats["total_length"] / count if count > 0 else 0
-    await message.answer(f"Ваша активность:\nСообщений: {count}\nСредняя длина: {avg_length:.2f} символов")
+    async def _load(self, key, ttl: float, loader, flight: _Flight, preloaded: bool = False) -> CachedResult:
+        path = os.path.join(self._directory, f"{uuid.uuid4().hex}.spool")
+        try:
+            columns, rows_count, digest = await loader(path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            raise
+        finally:
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+        result = CachedResult(path, columns, rows_count, digest)
+        # Ссылка резервируется за каждым ожидающим в момент готовности результата
+        result.refs = flight.waiters
+        result.preloaded = preloaded
+        if ttl > 0 and result.size <= (self._preload_max_bytes if preloaded else self._max_bytes):
+            result.expires_at = time.monotonic() + ttl
+            self._store(key, result)
+        else:
+            result.evicted = True
+        return result
 
-async def all_stats_handler(message: types.Message):
-    user_id = message.from_user.id
-    if get_user_department(user_id) != "admin":
-        await message.answer("У вас нет доступа к этой команде.")
-        return
+    async def preload(self, key, ttl: float, loader) -> bool:
+        """
+        Принудительно загружает свежий результат по ключу и сохраняет его на ttl секунд.
+        Возвращает False, если результат не поместился в бюджет и не сохранён.
+        """
+        if key in self._entries:
+            self._remove(key)
+        async with self.use(key, ttl, loader, preloaded=True) as result:
+            stored = self._entries.get(key) is result
+        if not stored:
+            logger.warning("Заранее подготовленный результат %s (%s байт) не сохранён в кэше: "
+                           "он больше бюджета RESULT_CACHE_PRELOAD_MAX_BYTES", key, result.size)
+        return stored
 
-    if not ACTIVITY_STATS:
-        await message.answer("Нет данных по активности.")
-        return
+    def _store(self, key, result: CachedResult):
+        now = time.monotonic()
+        for old_key in [k for k, entry in self._entries.items() if entry.expires_at <= now]:
+            self._remove(old_key)
+        self._entries[key] = result
+        if result.preloaded:
+            self._preload_size += result.size
+        else:
+            self._size += result.size
+        # Обычные и заранее подготовленные результаты вытесняются каждый в пределах своего бюджета
+        while self._size > self._max_bytes:
+            self._remove(next(k for k, entry in self._entries.items() if not entry.preloaded))
+        while self._preload_size > self._preload_max_bytes:
+            old_key = next(k for k, entry in self._entries.items() if entry.preloaded)
+            logger.warning("Заранее подготовленный результат %s вытеснен из кэша", old_key)
+            self._remove(old_key)
 
-    lines = []
-    for uid, stats in ACTIVITY_STATS.items():
-        count = stats["count"]
-        avg_length = stats["total_length"] / count if count > 0 else 0
-        lines.append(f"User {uid}: сообщений {count}, ср. длина {avg_length:.2f}")
-    await message.answer("\n".join(lines))
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if entry.preloaded:
+            self._preload_size -= entry.size
+        else:
+            self._size -= entry.size
+        entry.evict()
+
+    def close(self):
+        for key in list(self._entries):
+            self._remove(key)
+        shutil.rmtree(self._directory, ignore_errors=True)
 
 # ----------------------------
-# Регистрация хэндлеров через Dispatcher
+# Кэш file_id отправленных отчётов
 # ----------------------------
 
-def register_handlers(dp: Dispatcher):
-    dp.message.register(start_handler, Command("start"))
-    dp.message.register(service_selection_handler, ServiceSelection.waiting_for_service)
-    dp.message.register(track_activity)
-    dp.message.register(my_stats_handler, Command("my_stats"))
-    dp.message.register(all_stats_handler, Command("all_stats"))
-    dp.callback_query.register(query_callback_handler, lambda c: c.data and (":" in c.data))
+class FileIdCache:
+    """
+    Соответствие «ключ отчёта → список file_id Telegram» (по одному на часть выгрузки).
+    Ключ включает имя файла и sha256 данных, поэтому одинаковый отчёт повторно
+    не загружается, а отправляется по file_id. Записи хранятся в БД статистики
+    и переживают перезапуск бота.
+    """
+
+    def __init__(self):
+        self._memo = {}
+
+    async def get(self, key: str):
+        file_ids = self._memo.get(key)
+        if file_ids is not None or not DB_POOLS.has(STATS_DB):
+            return file_ids
+        try:
+            async with DB_POOLS.acquire(STATS_DB) as conn:
+                # Записи до появления многочастных выгрузок содержат только file_id
+                file_ids = await conn.fetchval(
+                    "SELECT COALESCE(file_ids, ARRAY[file_id]) FROM telegram_file_cache WHERE cache_key = $1", key
+                )
+        except Exception as e:
+            logger.error("Ошибка чтения кэша file_id: %s", e)
+            return None
+        if file_ids is not None:
+            self._memo[key] = file_ids
+        return file_ids
+
+    async def put(self, key: str, file_ids: list):
+        self._memo[key] = file_ids
+        if not DB_POOLS.has(STATS_DB):
+            return
+        try:
+            async with DB_POOLS.acquire(STATS_DB) as conn:
+                await conn.execute("""
+                    INSERT INTO telegram_file_cache (cache_key, file_id, file_ids) VALUES ($1, $2, $3)
+                    ON CONFLICT (cache_key) DO UPDATE
+                    SET file_id = EXCLUDED.file_id, file_ids = EXCLUDED.file_ids, created_at = now();
+                """, key, file_ids[0], file_ids)
+        except Exception as e:
+            logger.error("Ошибка записи кэша file_id: %s", e)
+
+    async def discard(self, key: str):
+        self._memo.pop(key, None)
+        if not DB_POOLS.has(STATS_DB):
+            return
+        try:
+            async with DB_POOLS.acquire(STATS_DB) as conn:
+                await conn.execute("DELETE FROM telegram_file_cache WHERE cache_key = $1", key)
+        except Exception as e:
+            logger.error("Ошибка удаления из кэша file_id: %s", e)
 
 # ----------------------------
-# Основной запуск бота
+# Модуль миграций
 # ----------------------------
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-    register_handlers(dp)
-    # Запуск миграций перед стартом бота
-    await run_migrations()
-    logger.info("Бот запускается...")
-    await dp.start_polling(bot)
+async def spool_records(chunks, path: str, progress=None):
+    """
+    Сохраняет поток порций записей во временный spool-файл (порции кортежей в pickle).
+    Записи asyncpg не сериализуются, поэтому каждая порция переводится в кортежи,
+    после чего файл можно обрабатывать в отдельном потоке или процессе.
+    Необязательная корутина progress(rows_count) вызывается после каждой порции.
+    Возвращает список колонок, количество строк и sha256 содержимого (версию данных).
+    """
+    columns = []
+    rows_count = 0
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        async for chunk in chunks:
+            if not columns:
+                columns = list(chunk[0].keys())
+                digest.update(pickle.dumps(columns, protocol=pickle.HIGHEST_PROTOCOL))
+            data = pickle.dumps([tuple(record) for record in chunk], protocol=pickle.HIGHEST_PROTOCOL)
+            digest.update(data)
+            f.write(data)
+            rows_count += len(chunk)
+            if progress is not None:
+                await progress(rows_count)
+    return columns, rows_count, digest.hexdigest()
+
+def iter_spool(path: str, offset: int = 0):
+    """
+    По порциям читает spool-файл, созданный spool_records, начиная с позиции offset.
+    Вместе с каждой порцией возвращает позицию следующей, с которой чтение можно продолжить.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield chunk, f.tell()
+
+class Codec:
+    """
+    Метод сжатия zip-архива. throughput – ориентировочная скорость формирования
+    сжатого CSV в МБ/с исходного CSV (замерена bench.py на формах выгрузок Nutsfarm),
+    по ней оценивается время этапа.
+    """
+
+    __slots__ = ("name", "method", "level", "throughput")
+
+    def __init__(self, name: str, method: int, level, throughput: float):
+        self.name = name
+        self.method = method
+        self.level = level
+        self.throughput = throughput
+
+# Кодеки от самого сильного сжатия к самому быстрому
+COMPRESSION_CODECS = {
+    "lzma": Codec("lzma", zipfile.ZIP_LZMA, None, 0.5),
+    "deflate9": Codec("deflate9", zipfile.ZIP_DEFLATED, 9, 3.5),
+    "deflate6": Codec("deflate6", zipfile.ZIP_DEFLATED, 6, 5),
+    "deflate1": Codec("deflate1", zipfile.ZIP_DEFLATED, 1, 9),
+    "store": Codec("store", zipfile.ZIP_STORED, None, 11),
+}
+
+def choose_codec(expected_size: int, time_budget: float = COMPRESSION_TIME_BUDGET):
+    """
+    Выбирает кодек для отчёта ожидаемого размера expected_size (в байтах).
+    Отчёты меньше THRESHOLD_SIZE не сжимаются (None). В режиме "auto" берётся
+    самый сильный кодек, укладывающийся в бюджет времени, иначе – самый быстрый из сжимающих.
+    """
+    if expected_size <= THRESHOLD_SIZE:
+        return None
+    if COMPRESSION_CODEC in COMPRESSION_CODECS:
+        return COMPRESSION_CODECS[COMPRESSION_CODEC]
+    size_mb = expected_size / (1024 * 1024)
+    for codec in COMPRESSION_CODECS.values():
+        if codec.method != zipfile.ZIP_STORED and size_mb / codec.throughput <= time_budget:
+            return codec
+    return COMPRESSION_CODECS["deflate1"]
+
+@contextlib.contextmanager
+def open_report_output(path: str, arcname: str, codec: Codec = None):
+    """
+    Открывает текстовый поток для записи отчёта. Если задан codec, данные сжимаются
+    по мере записи прямо в zip-архив path (элемент arcname), без промежуточного файла.
+    Вместе с потоком возвращает функцию, сообщающую, сколько байт уже записано в файл.
+    """
+    if codec is None:
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            def written():
+                f.flush()
+                return f.buffer.tell()
+            yield f, written
+        return
+    with zipfile.ZipFile(path, mode="w", compression=codec.method, compresslevel=codec.level) as zf:
+        with zf.open(arcname, mode="w", force_zip64=True) as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                def written():
+                    f.flush()
+                    return zf.fp.tell()
+                yield f, written
+
+def generate_csv(spool_path: str, columns: list, path: str, codec: Codec = None,
+                 offset: int = 0, max_bytes: int = None):
+    """
+    Кодирует spool-файл в CSV по пути path, начиная с позиции offset. Если задан codec,
+    CSV сразу сжимается в zip-архив path. В памяти одновременно находится не больше одной порции строк.
+    Если задан max_bytes, файл закрывается, когда следующая порция может в него не поместиться.
+    Возвращает путь и позицию, с которой продолжается следующая часть (None, если строки закончились).
+    Каждая часть – самостоятельный CSV со строкой заголовка.
+    """
+    arcname = os.path.splitext(os.path.basename(path))[0] + ".csv"
+    end = os.path.getsize(spool_path)
+    with open_report_output(path, arcname, codec) as (f, written):
+        if not columns:
+            f.write("Нет данных для отображения")
+            return path, None
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        size = written()
+        growth = 0
+        for chunk, next_offset in iter_spool(spool_path, offset):
+            writer.writerows(chunk)
+            if max_bytes is None:
+                continue
+            previous, size = size, written()
+            growth = max(growth, size - previous)
+            if size + growth > max_bytes and next_offset < end:
+                return path, next_offset
+    return path, None
+
+# numeric из Postgres хранится без потерь как decimal с фиксированным масштабом,
+# чтобы схема файла не зависела от точности значений в первой порции
+PARQUET_DECIMAL = pa.decimal128(38, 18)
+
+def _parquet_field(field: pa.Field) -> pa.Field:
+    # Колонка без значений в первой порции хранится как строка. numeric, который не помещается
+    # в PARQUET_DECIMAL (масштаб или число цифр целой части больше), – тоже строкой, а не float
+    if pa.types.is_null(field.type):
+        return pa.field(field.name, pa.string())
+    if pa.types.is_decimal(field.type):
+        fits = (field.type.scale <= PARQUET_DECIMAL.scale and field.type.precision - field.type.scale
+                <= PARQUET_DECIMAL.precision - PARQUET_DECIMAL.scale)
+        return pa.field(field.name, PARQUET_DECIMAL if fits else pa.string())
+    return field
+
+def _parquet_array(values) -> pa.Array:
+    # uuid из Postgres записывается строкой, как в XLSX: старые версии pyarrow не преобразуют uuid.UUID.
+    # Колонка результата однотипна, поэтому тип определяется по первому непустому значению
+    if isinstance(next((value for value in values if value is not None), None), uuid.UUID):
+        values = [None if value is None else str(value) for value in values]
+    return pa.array(values)
+
+def generate_parquet(spool_path: str, columns: list, path: str, offset: int = 0, max_bytes: int = None,
+                     row_group_size: int = 100000):
+    """
+    Кодирует spool-файл в Parquet со сжатием zstd, начиная с позиции offset.
+    Каждая порция переводится в колоночную таблицу Arrow целиком (по колонкам, без обхода строк),
+    порции объединяются в группы строк по row_group_size, схема файла берётся из первой порции.
+    Разбиение на части по max_bytes – как в generate_csv, по границам групп строк.
+    """
+    end = os.path.getsize(spool_path)
+    sink = pa.OSFile(path, "wb")
+    writer = None
+    pending = []
+    pending_rows = 0
+    growth = 0
+
+    def flush():
+        before = sink.tell()
+        writer.write_table(pa.concat_tables(pending))
+        pending.clear()
+        return sink.tell() - before
+
+    try:
+        for chunk, next_offset in iter_spool(spool_path, offset):
+            table = pa.Table.from_arrays([_parquet_array(values) for values in zip(*chunk)], names=columns)
+            if writer is None:
+                schema = pa.schema([_parquet_field(field) for field in table.schema])
+                writer = pq.ParquetWriter(sink, schema, compression="zstd")
+            pending.append(table.cast(writer.schema))
+            pending_rows += table.num_rows
+            if pending_rows >= row_group_size:
+                growth = max(growth, flush())
+                pending_rows = 0
+                if max_bytes is not None and sink.tell() + growth > max_bytes and next_offset < end:
+                    return path, next_offset
+        if writer is None:
+            pq.write_table(pa.table({name: pa.array([], pa.string()) for name in columns}), sink)
+        elif pending:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+        sink.close()
+    return path, None
+
+# Предельное число строк листа Excel (вместе со строкой заголовка)
+EXCEL_MAX_ROWS = 1048576
+# Начальная оценка отношения размера XLSX к прочитанной части spool-файла при разбиении на части:
+# на типичных отчётах (bench.py) книга примерно равна spool-файлу, на узких числовых таблицах – до 1.8 раза больше.
+# Следующие части выгрузки оцениваются по отношению, измеренному на готовой части, с запасом EXCEL_SIZE_MARGIN
+EXCEL_SIZE_RATIO = 1.0
+EXCEL_SIZE_MARGIN = 1.05
+
+def excel_cell(value):
+    """
+    Значение ячейки XLSX: Excel не хранит часовые пояса, поэтому время с поясом
+    переводится в SCHEDULE_TIMEZONE; типы, которых нет в Excel, записываются строкой.
+    Управляющие символы, недопустимые в XML листа, из строк удаляются.
+    """
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(SCHEDULE_TIMEZONE).replace(tzinfo=None)
+    if isinstance(value, (uuid.UUID, list, dict, datetime.timedelta)):
+        return str(value)
+    return value
+
+def excel_sheet_title(title: str, used: set) -> str:
+    # Название листа – не длиннее 31 символа, без символов []:*?/\ и уникальное в книге
+    base = re.sub(r"[\[\]:*?/\\]", " ", title)[:31].strip() or "Sheet"
+    candidate, number = base, 1
+    while candidate.lower() in used:
+        number += 1
+        suffix = f" ({number})"
+        candidate = base[:31 - len(suffix)] + suffix
+    used.add(candidate.lower())
+    return candidate
+
+def excel_sheet_writer(wb: Workbook, title: str, columns: list, used: set):
+    """
+    Создаёт лист title в книге write_only и возвращает функцию добавления на него строки.
+    Строки, не поместившиеся на лист, продолжаются на следующем листе с тем же заголовком.
+    """
+    ws = None
+    rows = EXCEL_MAX_ROWS
+
+    def append(row):
+        nonlocal ws, rows
+        if rows == EXCEL_MAX_ROWS:
+            ws = wb.create_sheet(excel_sheet_title(title, used))
+            ws.append(columns)
+            rows = 1
+        if row is not None:
+            ws.append([excel_cell(value) for value in row])
+            rows += 1
+
+    append(None)
+    return append
+
+def generate_excel(spool_path: str, columns: list, path: str, offset: int = 0, max_bytes: int = None,
+                   size_ratio: float = EXCEL_SIZE_RATIO):
+    """
+    Кодирует spool-файл в XLSX по пути path, начиная с позиции offset.
+    Книга write_only пишет строки листов во временные файлы на диске, поэтому в памяти
+    находится не больше одной порции строк. Разбиение на части по max_bytes – как в generate_csv,
+    но размер книги известен только после сохранения: до него он оценивается как прочитанная часть
+    spool-файла, умноженная на size_ratio. Если сохранённая часть всё же больше max_bytes,
+    она формируется заново с отношением, измеренным на ней самой.
+    """
+    end = os.path.getsize(spool_path)
+    previous = offset
+    growth = 0
+    chunks = 0
+    next_part = None
+    wb = Workbook(write_only=True)
+    if not columns:
+        wb.create_sheet("Sheet1").append(["Нет данных для отображения"])
+        wb.save(path)
+        return path, None
+    append = excel_sheet_writer(wb, "Sheet", columns, set())
+    for chunk, next_offset in iter_spool(spool_path, offset):
+        for row in chunk:
+            append(row)
+        chunks += 1
+        growth = max(growth, next_offset - previous)
+        previous = next_offset
+        if max_bytes is not None and (next_offset - offset + growth) * size_ratio > max_bytes and next_offset < end:
+            next_part = next_offset
+            break
+    wb.save(path)
+    size = os.path.getsize(path)
+    # Часть из одной порции строк меньше уже не сделать
+    if max_bytes is not None and size > max_bytes and chunks > 1:
+        ratio = size / (previous - offset)
+        logger.info("Часть XLSX %s больше лимита (%s байт), формируется заново с отношением %.2f", path, size, ratio)
+        return generate_excel(spool_path, columns, path, offset, max_bytes,
+                              size_ratio=max(ratio, size_ratio) * EXCEL_SIZE_MARGIN)
+    return path, next_part
+
+def generate_dashboard_xlsx(path: str, sheets: list) -> str:
+    """
+    Собирает результаты нескольких запросов в одну книгу XLSX, по листу на запрос.
+    sheets – список (название, путь к spool-файлу, колонки).
+    """
+    wb = Workbook(write_only=True)
+    used = set()
+    for title, spool_path, columns in sheets:
+        append = excel_sheet_writer(wb, title, columns, used)
+        for chunk, _ in iter_spool(spool_path):
+            for row in chunk:
+                append(row)
+    wb.save(path)
+    return path
+
+async def init_stats_table():
+    """
+    Инициализация таблицы для статистики сообщений.
+    Таблица создаётся с дополнительными полями для названия чата и топика (если он есть).
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS activity_stats (
+                chat_id BIGINT,
+                user_id BIGINT,
+                chat_title TEXT,
+                chat_topic TEXT,
+                message_count INTEGER,
+                total_length INTEGER,
+                PRIMARY KEY (chat_id, user_id)
+            );
+        """)
+        logger.info("Таблица activity_stats успешно инициализирована.")
+
+# Партиция по умолчанию принимает строки, для дня которых ещё нет партиции (если обслуживание отстало),
+# чтобы сброс буфера активности не падал и не откатывал вместе с историей накопительные счётчики.
+ACTIVITY_DEFAULT_PARTITION = "activity_hourly_default"
+
+def _activity_partition_name(day: datetime.date) -> str:
+    return f"activity_hourly_{day:%Y%m%d}"
+
+async def _create_activity_partition(conn, day: datetime.date):
+    """
+    Создаёт партицию дня day, перенося в неё строки этого дня из партиции по умолчанию:
+    иначе PostgreSQL не даст создать партицию, пересекающуюся с данными партиции по умолчанию.
+    """
+    start = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+    end = start + datetime.timedelta(days=1)
+    async with conn.transaction():
+        if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", _activity_partition_name(day)):
+            return
+        # Блокировка не даёт сбросу буфера дописать строки этого дня между переносом и созданием партиции
+        await conn.execute(f"LOCK TABLE {ACTIVITY_DEFAULT_PARTITION} IN ACCESS EXCLUSIVE MODE;")
+        rows = await conn.fetch(f"""
+            DELETE FROM {ACTIVITY_DEFAULT_PARTITION} WHERE bucket >= $1 AND bucket < $2
+            RETURNING bucket, chat_id, user_id, message_count, total_length;
+        """, start, end)
+        await conn.execute(f"""
+            CREATE TABLE {_activity_partition_name(day)} PARTITION OF activity_hourly
+            FOR VALUES FROM ('{day.isoformat()} 00:00+00') TO ('{(day + datetime.timedelta(days=1)).isoformat()} 00:00+00');
+        """)
+        if rows:
+            await conn.executemany("""
+                INSERT INTO activity_hourly (bucket, chat_id, user_id, message_count, total_length)
+                VALUES ($1, $2, $3, $4, $5);
+            """, [tuple(row) for row in rows])
+            logger.warning("В партицию %s перенесено строк из партиции по умолчанию: %d",
+                           _activity_partition_name(day), len(rows))
+
+async def maintain_activity_partitions(retention_days: int = ACTIVITY_RETENTION_DAYS,
+                                       ahead_days: int = ACTIVITY_PARTITIONS_AHEAD):
+    """
+    Создаёт дневные партиции activity_hourly на ahead_days вперёд и удаляет партиции
+    старше retention_days. Границы партиций – сутки по UTC.
+    Строки, попавшие в партицию по умолчанию, переносятся в созданные партиции или удаляются по сроку хранения.
+    """
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        for offset in range(-1, ahead_days + 1):
+            await _create_activity_partition(conn, today + datetime.timedelta(days=offset))
+        partitions = await conn.fetch("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'activity_hourly'::regclass;
+        """)
+        oldest = _activity_partition_name(today - datetime.timedelta(days=retention_days))
+        for row in partitions:
+            # Имена партиций содержат дату в формате ГГГГММДД, поэтому сравниваются как строки
+            if row["relname"] != ACTIVITY_DEFAULT_PARTITION and row["relname"] < oldest:
+                await conn.execute(f"DROP TABLE IF EXISTS {row['relname']};")
+                logger.info("Партиция %s удалена по сроку хранения", row["relname"])
+        await conn.execute(
+            f"DELETE FROM {ACTIVITY_DEFAULT_PARTITION} WHERE bucket < $1;",
+            datetime.datetime.combine(today - datetime.timedelta(days=retention_days), datetime.time(),
+                                      datetime.timezone.utc),
+        )
+
+async def init_activity_history_table():
+    """
+    Инициализация почасовой истории активности чатов, секционированной по дням.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS activity_hourly (
+                bucket TIMESTAMPTZ NOT NULL,
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                message_count INTEGER NOT NULL,
+                total_length INTEGER NOT NULL,
+                PRIMARY KEY (bucket, chat_id, user_id)
+            ) PARTITION BY RANGE (bucket);
+        """)
+        await conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {ACTIVITY_DEFAULT_PARTITION} PARTITION OF activity_hourly DEFAULT;"
+        )
+    await maintain_activity_partitions()
+    logger.info("Таблица activity_hourly успешно инициализирована.")
+
+async def init_file_cache_table():
+    """
+    Инициализация таблицы кэша file_id отправленных отчётов.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_file_cache (
+                cache_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            ALTER TABLE telegram_file_cache ADD COLUMN IF NOT EXISTS file_ids TEXT[];
+        """)
+        logger.info("Таблица telegram_file_cache успешно инициализирована.")
+
+async def init_rollup_tables():
+    """
+    Инициализация таблиц дневных роллапов активности Nutsfarm:
+    активные пользователи по дням, первый/последний день активности пользователя
+    и отметка последнего обработанного дня.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS nutsfarm_daily_active_users (
+                day DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                tx_count INTEGER NOT NULL,
+                PRIMARY KEY (day, user_id)
+            );
+            CREATE TABLE IF NOT EXISTS nutsfarm_user_activity (
+                user_id BIGINT PRIMARY KEY,
+                first_day DATE NOT NULL,
+                last_day DATE NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS nutsfarm_user_activity_last_day_idx
+                ON nutsfarm_user_activity (last_day);
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_day DATE NOT NULL
+            );
+        """)
+        logger.info("Таблицы роллапов успешно инициализированы.")
+
+async def init_subscriptions_table():
+    """
+    Инициализация таблицы подписок на ежедневную доставку отчётов.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_subscriptions (
+                user_id BIGINT NOT NULL,
+                service_id TEXT NOT NULL,
+                callback TEXT NOT NULL,
+                deliver_at TIME NOT NULL,
+                last_sent DATE,
+                PRIMARY KEY (user_id, service_id, callback)
+            );
+            ALTER TABLE report_subscriptions ADD COLUMN IF NOT EXISTS export_format TEXT NOT NULL DEFAULT 'csv';
+            CREATE TABLE IF NOT EXISTS scheduled_runs (
+                name TEXT NOT NULL,
+                day DATE NOT NULL,
+                PRIMARY KEY (name, day)
+            );
+        """)
+        logger.info("Таблица report_subscriptions успешно инициализирована.")
+
+async def init_fsm_table():
+    """
+    Инициализация таблицы состояний диалогов (FSM), общей для всех реплик бота.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                storage_key TEXT PRIMARY KEY,
+                state TEXT,
+                data JSONB NOT NULL DEFAULT '{}',
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        logger.info("Таблица fsm_storage успешно инициализирована.")
+
+async def init_watermarks_table():
+    """
+    Инициализация таблицы отметок выгрузок только новых строк (по пользователю и запросу).
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS export_watermarks (
+                user_id BIGINT NOT NULL,
+                service_id TEXT NOT NULL,
+                callback TEXT NOT NULL,
+                watermark TEXT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (user_id, service_id, callback)
+            );
+        """)
+        logger.info("Таблица export_watermarks успешно инициализирована.")
+
+async def init_user_activity_table():
+    """
+    Инициализация таблицы статистики сообщений пользователей (/my_stats, /all_stats).
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_activity_stats (
+                user_id BIGINT PRIMARY KEY,
+                message_count BIGINT NOT NULL,
+                total_length BIGINT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            CREATE INDEX IF NOT EXISTS user_activity_stats_message_count_idx
+                ON user_activity_stats (message_count DESC, user_id);
+        """)
+        logger.info("Таблица user_activity_stats успешно инициализирована.")
+
+@contextlib.asynccontextmanager
+async def cluster_lock(name: str, wait: bool = False):
+    """
+    Блокировка между репликами бота (advisory-блокировка в БД статистики) на время блока.
+    Выдаёт True, если блокировка получена; при wait=False не ждёт её освобождения и выдаёт False.
+    Блокировка сессионная и держится отдельным соединением вне пула без открытой транзакции:
+    долгий блок (например, первое заполнение роллапов) не занимает слот пула и не мешает VACUUM.
+    При обрыве соединения блокировка снимается сервером.
+    """
+    if not DB_POOLS.has(STATS_DB):
+        yield True
+        return
+    lock_id = zlib.crc32(name.encode())
+    conn = await DB_POOLS.connect(STATS_DB)
+    try:
+        if wait:
+            await conn.execute("SELECT pg_advisory_lock($1)", lock_id)
+            acquired = True
+        else:
+            acquired = await conn.fetchval("SELECT pg_try_advisory_lock($1)", lock_id)
+        try:
+            yield acquired
+        finally:
+            if acquired and not conn.is_closed():
+                with contextlib.suppress(asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                    await conn.execute("SELECT pg_advisory_unlock($1)", lock_id)
+    finally:
+        await conn.close()
+
+async def claim_scheduled_run(name: str, day: datetime.date) -> bool:
+    """
+    Отмечает запуск задачи по расписанию за день. True получает только одна реплика.
+    """
+    if not DB_POOLS.has(STATS_DB):
+        return True
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("DELETE FROM scheduled_runs WHERE day < $1", day - datetime.timedelta(days=7))
+        return await conn.fetchval("""
+            INSERT INTO scheduled_runs (name, day) VALUES ($1, $2)
+            ON CONFLICT DO NOTHING RETURNING true;
+        """, name, day) is not None
+
+async def run_migrations():
+    """
+    Запускает все миграции для БД.
+    Здесь можно добавить и другие миграционные шаги.
+    """
+    # Реплики запускаются одновременно: миграции выполняет одна, остальные ждут её завершения
+    async with cluster_lock("migrations", wait=True):
+        await init_stats_table()
+        await init_activity_history_table()
+        await init_file_cache_table()
+        await init_rollup_tables()
+        await init_subscriptions_table()
+        await init_watermarks_table()
+        await init_user_activity_table()
+        await init_fsm_table()
+    logger.info("Все миграции успешно выполнены.")
+
+# ----------------------------
+# Вспомогательные функции
+# ----------------------------
+
+class QueryError(Exception):
+    """Ошибка выполнения SQL-запроса отчёта."""
+
+
+class QueryTimeoutError(QueryError):
+    """Запрос отчёта прерван по истечении отведённого ему времени."""
+
+    def __init__(self, timeout: float):
+        super().__init__(f"запрос выполнялся дольше {timeout:g} с")
+        self.timeout = timeout
+
+
+async def load_query_to_spool(query: str, db_instance: str, path: str, progress=None, timeout: float = None,
+                              args: tuple = ()):
+    """
+    Выполняет запрос с параметрами args и сохраняет результат в spool-файл по пути path.
+    """
+    with METRICS.timer("report_query_seconds", db=db_instance):
+        async with contextlib.aclosing(stream_records(query, db_instance, args, timeout=timeout)) as chunks:
+            columns, rows_count, digest = await spool_records(chunks, path, progress)
+    observe_spool(db_instance, path, rows_count)
+    return columns, rows_count, digest
+
+def observe_spool(db_instance: str, path: str, rows_count: int):
+    METRICS.observe("report_rows", rows_count, db=db_instance)
+    METRICS.observe("report_spool_bytes", os.path.getsize(path), db=db_instance)
+
+async def stream_records(query: str, db_instance: str, args: tuple = (), chunk_size: int = EXPORT_CHUNK_SIZE,
+                         timeout: float = None, readonly: bool = True):
+    """
+    Выполняет запрос через серверный курсор и отдаёт результат порциями по chunk_size записей.
+    С readonly=True запрос может выполниться на реплике (см. PoolRegistry.acquire); запросы,
+    которым нужны данные без отставания, передают readonly=False.
+    С timeout запрос ограничен по времени: statement_timeout прерывает на сервере каждую выборку порции,
+    а общая длительность проверяется между порциями. Превышение пробрасывается как QueryTimeoutError,
+    остальные ошибки базы данных – как QueryError.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        async with DB_POOLS.acquire(db_instance, readonly=readonly) as conn:
+            # Серверный курсор работает только внутри транзакции
+            async with conn.transaction(readonly=True):
+                if timeout:
+                    await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+                cursor = await conn.cursor(query, *args)
+                while True:
+                    chunk = await cursor.fetch(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise QueryTimeoutError(timeout)
+    except asyncpg.QueryCanceledError as e:
+        if not timeout:
+            raise QueryError(str(e)) from e
+        raise QueryTimeoutError(timeout) from e
+    except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+        raise QueryError(str(e)) from e
+
+def query_timeout(query_config: dict) -> float:
+    return query_config.get("timeout", QUERY_TIMEOUT)
+
+def result_cache_key(query_config: dict, params: tuple = ()) -> tuple:
+    # Результаты с разными значениями параметров кэшируются отдельно
+    return (query_config["db_instanse"], query_config["callback"]) + tuple(params)
+
+async def explain_query(query: str, db_instance: str, args: tuple = ()):
+    """
+    Оценка запроса планировщиком без выполнения: (стоимость, число строк).
+    """
+    async with DB_POOLS.acquire(db_instance, readonly=True) as conn:
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    root = json.loads(plan)[0]["Plan"]
+    return root["Total Cost"], root["Plan Rows"]
+
+def budget_overrun(query_config: dict, cost: float, rows: int) -> float:
+    """
+    Во сколько раз оценка запроса превышает его бюджет (0, если бюджет не задан).
+    """
+    max_cost = query_config.get("max_cost", QUERY_MAX_COST)
+    max_rows = query_config.get("max_rows", QUERY_MAX_ROWS)
+    return max(cost / max_cost if max_cost else 0.0, rows / max_rows if max_rows else 0.0)
+
+def delta_query(query: str, column: str, column_type: str, since: str = None):
+    """
+    Оборачивает запрос отчёта так, чтобы он возвращал только строки со значением column больше since,
+    упорядоченные по column. Без since возвращаются все строки (первая выгрузка).
+    """
+    sql = f"SELECT * FROM ({query.strip().rstrip(';')}) AS report"
+    args = ()
+    if since is not None:
+        sql += f" WHERE report.{column} > CAST($1::text AS {column_type})"
+        args = (since,)
+    return sql + f" ORDER BY report.{column} NULLS FIRST", args
+
+async def load_delta_to_spool(query_config: dict, db_instance: str, path: str, since: str = None, progress=None):
+    """
+    Сохраняет в spool-файл только новые строки запроса с параметром watermark.
+    Кроме колонок, количества строк и sha256 возвращает новую отметку –
+    наибольшее значение колонки watermark среди выгруженных строк (или since, если строк нет).
+    """
+    column = query_config["watermark"]
+    sql, args = delta_query(query_config["sql"], column, query_config.get("watermark_type", "bigint"), since)
+    watermark = since
+
+    async def tracked(chunks):
+        nonlocal watermark
+        async for chunk in chunks:
+            # Строки упорядочены по отметке, наибольшее значение – в последней строке порции
+            if chunk[-1][column] is not None:
+                watermark = str(chunk[-1][column])
+            yield chunk
+
+    with METRICS.timer("report_query_seconds", db=db_instance):
+        async with contextlib.aclosing(stream_records(sql, db_instance, args,
+                                                      timeout=query_timeout(query_config))) as chunks:
+            columns, rows_count, digest = await spool_records(tracked(chunks), path, progress)
+    observe_spool(db_instance, path, rows_count)
+    return columns, rows_count, digest, watermark
+
+async def get_export_watermark(user_id: int, service_id: str, query_key: str):
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        return await conn.fetchval("""
+            SELECT watermark FROM export_watermarks
+            WHERE user_id = $1 AND service_id = $2 AND callback = $3;
+        """, user_id, service_id, query_key)
+
+async def set_export_watermark(user_id: int, service_id: str, query_key: str, watermark: str):
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            INSERT INTO export_watermarks (user_id, service_id, callback, watermark) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id, service_id, callback) DO UPDATE
+            SET watermark = EXCLUDED.watermark, updated_at = now();
+        """, user_id, service_id, query_key, watermark)
+
+def get_user_department(user_id: int):
+    return ALLOWED_USERS.get(user_id)
+
+# ----------------------------
+# Реестр сервисов и запросов
+# ----------------------------
+
+def parse_date_param(text: str) -> datetime.date:
+    """
+    Дата в формате ДД.ММ.ГГГГ или ГГГГ-ММ-ДД, а также относительная: today или -Nd (N дней назад).
+    """
+    today = datetime.datetime.now(SCHEDULE_TIMEZONE).date()
+    text = text.strip().lower()
+    if text in ("today", "сегодня"):
+        return today
+    match = re.fullmatch(r"-(\d+)[dд]?", text)
+    if match:
+        return today - datetime.timedelta(days=int(match.group(1)))
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("дата должна быть в формате ДД.ММ.ГГГГ")
+
+
+class QueryParam:
+    """
+    Параметр запроса отчёта, который пользователь вводит перед выполнением.
+    В SQL параметры передаются как $1, $2, ... в порядке объявления.
+    """
+
+    TYPES = {
+        "date": "дата ДД.ММ.ГГГГ, today или -Nd (N дней назад)",
+        "int": "целое число",
+        "text": "текст",
+    }
+
+    __slots__ = ("name", "label", "type", "default", "min", "max", "after")
+
+    def __init__(self, spec: dict):
+        self.name = spec.get("name")
+        self.label = spec.get("label") or self.name
+        self.type = spec.get("type")
+        self.default = spec.get("default")
+        self.min = spec.get("min")
+        self.max = spec.get("max")
+        # Имя предыдущего параметра, значение которого не может быть больше этого (начало периода)
+        self.after = spec.get("after")
+        if not (isinstance(self.name, str) and self.name.isidentifier()):
+            raise ValueError(f"у параметра должно быть имя: {spec}")
+        if self.type not in self.TYPES:
+            raise ValueError(f"неизвестный тип параметра {self.name}: {self.type!r}")
+        if self.default is not None:
+            self.parse(self.default)
+
+    def parse(self, text):
+        """
+        Значение параметра из введённого текста; ValueError с понятным пользователю описанием ошибки.
+        """
+        text = str(text).strip()
+        if self.type == "date":
+            return parse_date_param(text)
+        if self.type == "int":
+            try:
+                value = int(text)
+            except ValueError:
+                raise ValueError("нужно целое число") from None
+            if self.min is not None and value < self.min:
+                raise ValueError(f"число должно быть не меньше {self.min}")
+            if self.max is not None and value > self.max:
+                raise ValueError(f"число должно быть не больше {self.max}")
+            return value
+        if not text or len(text) > 200:
+            raise ValueError("нужен непустой текст до 200 символов")
+        return text
+
+    def format(self, value) -> str:
+        return f"{value:%d.%m.%Y}" if self.type == "date" else str(value)
+
+    def prompt(self) -> str:
+        text = f"Введите «{self.label}» ({self.TYPES[self.type]})."
+        if self.default is not None:
+            text += f" Отправьте «-», чтобы взять значение по умолчанию: {self.format(self.parse(self.default))}."
+        return text
+
+
+class QueryRoute:
+    """
+    Запрос сервиса с компактным числовым идентификатором для callback_data.
+    Идентификатор вычисляется из service_id и callback запроса, поэтому не меняется
+    при перестановке запросов в конфигурации, и кнопки старых сообщений остаются рабочими.
+    """
+
+    __slots__ = ("id", "service_id", "config", "params")
+
+    def __init__(self, service_id: str, config: dict):
+        self.id = str(zlib.crc32(f"{service_id}:{config['callback']}".encode("utf-8")))
+        self.service_id = service_id
+        self.config = config
+        self.params = [QueryParam(spec) for spec in config.get("params", ())]
+
+    def defaults(self):
+        """
+        Значения параметров по умолчанию (для подписок и подготовки по расписанию)
+        или None, если у какого-то параметра значения по умолчанию нет.
+        """
+        if any(param.default is None for param in self.params):
+            return None
+        return tuple(param.parse(param.default) for param in self.params)
+
+    def describe(self, values) -> str:
+        return ", ".join(f"{param.label}: {param.format(value)}" for param, value in zip(self.params, values))
+
+
+class ServiceRegistry:
+    """
+    Индекс SERVICES_CONFIG и SERVICE_QUERIES, собираемый один раз при запуске:
+    поиск сервисов и запросов за O(1) и готовые клавиатуры для отделов и сервисов.
+    Конфигурация проверяется при сборке, ошибки в записях останавливают запуск бота.
+    """
+
+    def __init__(self, services_config: dict, service_queries: dict, databases):
+        self._services = {}
+        self._dept_services = {"admin": []}
+        self._routes = {}
+        self._routes_by_key = {}
+        errors = []
+
+        for group, services in services_config.items():
+            self._dept_services[group] = []
+            for service in services:
+                if not service.get("id") or not service.get("name"):
+                    errors.append(f"SERVICES_CONFIG[{group}]: у сервиса должны быть id и name: {service}")
+                    continue
+                known = self._services.get(service["id"])
+                if known is not None and known["name"] != service["name"]:
+                    errors.append(f"SERVICES_CONFIG[{group}]: сервис {service['id']} объявлен с разными названиями")
+                self._services.setdefault(service["id"], service)
+                self._dept_services[group].append(service)
+                if known is None:
+                    self._dept_services["admin"].append(service)
+
+        for service_id, queries in service_queries.items():
+            if service_id not in self._services:
+                errors.append(f"SERVICE_QUERIES[{service_id}]: сервис не описан в SERVICES_CONFIG")
+            for config in queries:
+                error = self._validate_query(config, databases)
+                if error:
+                    errors.append(f"SERVICE_QUERIES[{service_id}] {config.get('name', config.get('callback'))!r}: {error}")
+                    continue
+                route = QueryRoute(service_id, config)
+                if (service_id, config["callback"]) in self._routes_by_key:
+                    errors.append(f"SERVICE_QUERIES[{service_id}]: повторяется callback {config['callback']!r}")
+                elif route.id in self._routes:
+                    errors.append(f"SERVICE_QUERIES[{service_id}]: совпадает идентификатор callback {config['callback']!r}")
+                self._routes[route.id] = route
+                self._routes_by_key[(service_id, config["callback"])] = route
+
+        for dept, services in self._dept_services.items():
+            names = [service["name"] for service in services]
+            if len(names) != len(set(names)):
+                errors.append(f"SERVICES_CONFIG[{dept}]: названия сервисов повторяются")
+        if errors:
+            raise ValueError("Ошибки в конфигурации сервисов:\n" + "\n".join(errors))
+
+        self._service_ids = {dept: frozenset(service["id"] for service in services)
+                             for dept, services in self._dept_services.items()}
+        self._services_by_name = {dept: {service["name"]: service for service in services}
+                                  for dept, services in self._dept_services.items()}
+        self._reply_keyboards = {}
+        self._inline_keyboards = {}
+        self._subscribe_keyboards = {}
+
+    @staticmethod
+    def _validate_query(config: dict, databases) -> str:
+        for key in ("name", "callback", "sql", "db_instanse"):
+            if not isinstance(config.get(key), str) or not config[key].strip():
+                return f"не задан параметр {key}"
+        if config["db_instanse"] not in databases:
+            return f"неизвестная БД {config['db_instanse']!r}"
+        if config.get("kind", "kpi") not in JOB_PRIORITIES:
+            return f"неизвестный kind {config['kind']!r}"
+        cache_ttl = config.get("cache_ttl", 0)
+        if not isinstance(cache_ttl, (int, float)) or cache_ttl < 0:
+            return "cache_ttl должен быть неотрицательным числом"
+        if config.get("pregenerate"):
+            try:
+                parse_schedule_time(config["pregenerate"])
+            except ValueError:
+                return f"pregenerate должен быть в формате ЧЧ:ММ, а не {config['pregenerate']!r}"
+        if "watermark" in config and not (isinstance(config["watermark"], str) and config["watermark"].isidentifier()):
+            return "watermark должен быть именем колонки"
+        if config.get("params"):
+            if config.get("watermark"):
+                return "params и watermark нельзя использовать в одном запросе"
+            try:
+                params = [QueryParam(spec) for spec in config["params"]]
+            except ValueError as e:
+                return str(e)
+            seen = {}
+            for param in params:
+                if param.after is not None and (param.after not in seen or seen[param.after].type != param.type):
+                    return f"after параметра {param.name} должен ссылаться на предыдущий параметр того же типа"
+                seen[param.name] = param
+        return ""
+
+    def services_for(self, dept: str) -> list:
+        return self._dept_services.get(dept, [])
+
+    def service_by_name(self, dept: str, name: str):
+        return self._services_by_name.get(dept, {}).get(name)
+
+    def service_name(self, service_id: str) -> str:
+        return self._services[service_id]["name"]
+
+    def has_service(self, dept: str, service_id: str) -> bool:
+        return service_id in self._service_ids.get(dept, ())
+
+    def route(self, query_id: str):
+        return self._routes.get(query_id)
+
+    def find_route(self, service_id: str, query_key: str):
+        return self._routes_by_key.get((service_id, query_key))
+
+    def routes(self):
+        return self._routes.values()
+
+    def dashboard_routes(self, service_id: str) -> list:
+        """
+        Запросы сводки «Все отчёты сервиса»: показатели (kind "kpi") без обязательных параметров.
+        Выгрузки не входят в сводку – их результаты слишком велики для общей книги.
+        """
+        return [route for route in self._routes.values()
+                if route.service_id == service_id and route.config.get("kind", "kpi") == "kpi"
+                and route.defaults() is not None]
+
+    def reply_keyboard(self, dept: str) -> ReplyKeyboardMarkup:
+        keyboard = self._reply_keyboards.get(dept)
+        if keyboard is None:
+            # Формируем список рядов кнопок – каждый ряд содержит одну кнопку
+            buttons = [[KeyboardButton(text=service["name"])] for service in self.services_for(dept)]
+            keyboard = self._reply_keyboards[dept] = ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+        return keyboard
+
+    def inline_keyboard(self, service_id: str) -> InlineKeyboardMarkup:
+        keyboard = self._inline_keyboards.get(service_id)
+        if keyboard is None:
+            rows = []
+            for route in self._routes.values():
+                if route.service_id != service_id:
+                    continue
+                rows.append([InlineKeyboardButton(text=route.config["name"], callback_data=f"q:{route.id}")])
+                if route.config.get("watermark"):
+                    rows.append([InlineKeyboardButton(
+                        text=f"{route.config['name']}: только новые строки", callback_data=f"qd:{route.id}"
+                    )])
+            if len(self.dashboard_routes(service_id)) > 1:
+                rows.append([InlineKeyboardButton(text="Все отчёты сервиса", callback_data=f"dash:{service_id}")])
+            keyboard = self._inline_keyboards[service_id] = InlineKeyboardMarkup(inline_keyboard=rows)
+        return keyboard
+
+    def subscribe_keyboard(self, dept: str) -> InlineKeyboardMarkup:
+        keyboard = self._subscribe_keyboards.get(dept)
+        if keyboard is None:
+            # Подписка выполняет запрос со значениями параметров по умолчанию
+            rows = [
+                [InlineKeyboardButton(text=f"{self.service_name(route.service_id)}: {route.config['name']}",
+                                      callback_data=f"sub:{route.id}")]
+                for route in self._routes.values()
+                if self.has_service(dept, route.service_id) and all(p.default is not None for p in route.params)
+            ]
+            keyboard = self._subscribe_keyboards[dept] = InlineKeyboardMarkup(inline_keyboard=rows)
+        return keyboard
+
+
+def get_reply_keyboard_for_services(dept: str):
+    return SERVICE_REGISTRY.reply_keyboard(dept)
+
+def get_service_by_name(dept: str, name: str):
+    return SERVICE_REGISTRY.service_by_name(dept, name)
+
+def get_query_config(service_id: str, query_key: str):
+    route = SERVICE_REGISTRY.find_route(service_id, query_key)
+    return route.config if route is not None else None
+
+def user_has_service(user_id: int, service_id: str) -> bool:
+    return SERVICE_REGISTRY.has_service(get_user_department(user_id), service_id)
+
+def get_inline_keyboard_for_service(service_id: str):
+    return SERVICE_REGISTRY.inline_keyboard(service_id)
+
+# ----------------------------
+# Обновление статистики в БД (с chat_title и chat_topic)
+# ----------------------------
+
+async def upsert_activity_batch(batch: dict):
+    """
+    Записывает накопленную статистику в одной транзакции: накопительные счётчики
+    и почасовую историю activity_hourly.
+    batch: {(chat_id, user_id): [message_count, total_length, chat_title, chat_topic]}.
+    Для существующих пар chat_id/user_id счётчики увеличиваются, а название чата и топик обновляются.
+    """
+    query = """
+    INSERT INTO activity_stats (chat_id, user_id, chat_title, chat_topic, message_count, total_length)
+    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::int[], $6::int[])
+    ON CONFLICT (chat_id, user_id) DO UPDATE
+    SET message_count = activity_stats.message_count + EXCLUDED.message_count,
+        total_length = activity_stats.total_length + EXCLUDED.total_length,
+        chat_title = EXCLUDED.chat_title,
+        chat_topic = EXCLUDED.chat_topic;
+    """
+    # Почасовая история: сообщения относятся к часу сброса буфера (буфер сбрасывается каждые несколько секунд)
+    history_query = """
+    INSERT INTO activity_hourly (bucket, chat_id, user_id, message_count, total_length)
+    SELECT date_trunc('hour', now()), * FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::int[])
+    ON CONFLICT (bucket, chat_id, user_id) DO UPDATE
+    SET message_count = activity_hourly.message_count + EXCLUDED.message_count,
+        total_length = activity_hourly.total_length + EXCLUDED.total_length;
+    """
+    # Сортировка по ключу задаёт единый порядок блокировок строк
+    keys = sorted(batch)
+    values = [batch[key] for key in keys]
+    chat_ids = [key[0] for key in keys]
+    user_ids = [key[1] for key in keys]
+    message_counts = [value[0] for value in values]
+    total_lengths = [value[1] for value in values]
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        async with conn.transaction():
+            await conn.execute(
+                query,
+                chat_ids,
+                user_ids,
+                [value[2] for value in values],
+                [value[3] for value in values],
+                message_counts,
+                total_lengths,
+            )
+            await conn.execute(history_query, chat_ids, user_ids, message_counts, total_lengths)
+
+
+class ActivityBuffer:
+    """
+    Буфер статистики сообщений групповых чатов (write-behind).
+    Сообщения агрегируются в памяти по паре (chat_id, user_id) и сбрасываются в БД
+    одним запросом по таймеру или при достижении порога размера.
+    """
+
+    def __init__(self, flush_interval: float, flush_size: int, max_size: int):
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._max_size = max_size
+        self._entries = {}
+        self._flush_lock = asyncio.Lock()
+        self._timer_task = None
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def add(self, chat_id: int, user_id: int, chat_title: str, chat_topic: str, msg_length: int):
+        key = (chat_id, user_id)
+        if key not in self._entries and len(self._entries) >= self._max_size:
+            # Обратное давление: ждём сброса буфера, прежде чем принимать новые ключи
+            await self.flush()
+            if len(self._entries) >= self._max_size:
+                logger.warning("Буфер статистики переполнен, сообщение чата %s не учтено", chat_id)
+                return
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = [1, msg_length, chat_title, chat_topic]
+        else:
+            entry[0] += 1
+            entry[1] += msg_length
+            entry[2] = chat_title
+            entry[3] = chat_topic
+        METRICS.set("activity_buffer_entries", len(self._entries))
+        if len(self._entries) >= self._flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def _merge_back(self, batch: dict):
+        # Возвращает несохранённые данные в буфер, не затирая более свежие названия чатов
+        for key, value in batch.items():
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = value
+            else:
+                entry[0] += value[0]
+                entry[1] += value[1]
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._entries:
+                return
+            batch, self._entries = self._entries, {}
+            try:
+                with METRICS.timer("activity_flush_seconds"):
+                    await upsert_activity_batch(batch)
+                METRICS.observe("activity_flush_entries", len(batch))
+                logger.info("Статистика активности сохранена: %s записей", len(batch))
+            except Exception as e:
+                logger.error("Ошибка при обновлении статистики в БД: %s", e)
+                METRICS.inc("activity_flush_errors_total")
+                self._merge_back(batch)
+            METRICS.set("activity_buffer_entries", len(self._entries))
+
+    async def _timer_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._timer_task is None:
+            self._timer_task = asyncio.create_task(self._timer_loop())
+
+    async def stop(self):
+        """
+        Останавливает таймер и выполняет финальный сброс буфера.
+        """
+        if self._timer_task is not None:
+            self._timer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._timer_task
+            self._timer_task = None
+        if self._flush_task is not None:
+            with contextlib.suppress(Exception):
+                await self._flush_task
+        await self.flush()
+
+class UserActivity:
+    __slots__ = ("count", "total_length", "loaded_at")
+
+    def __init__(self, count: int = 0, total_length: int = 0):
+        self.count = count
+        self.total_length = total_length
+        self.loaded_at = time.monotonic()
+
+
+class ActivityStatsStore:
+    """
+    Статистика сообщений пользователей для /my_stats и /all_stats.
+    В памяти хранится не больше max_users пользователей (вытесняются давно не активные),
+    приращения периодически сохраняются в БД статистики, а при запуске кэш прогревается из БД.
+    Пользователь, вытесненный из памяти, при следующем запросе загружается из БД.
+    Запись в памяти перечитывается из БД не реже раза в snapshot_interval, чтобы учитывать
+    сообщения, посчитанные другими репликами бота.
+    """
+
+    def __init__(self, max_users: int, snapshot_interval: float):
+        self._max_users = max_users
+        self._snapshot_interval = snapshot_interval
+        self._entries = OrderedDict()
+        # Ещё не сохранённые приращения: user_id -> [message_count, total_length]
+        self._pending = {}
+        # Сохранение и чтение из БД не пересекаются, иначе приращение может быть учтено дважды или потеряно
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, user_id: int, msg_length: int):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.count += 1
+            entry.total_length += msg_length
+            self._entries.move_to_end(user_id)
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = [1, msg_length]
+        else:
+            pending[0] += 1
+            pending[1] += msg_length
+
+    def _put(self, user_id: int, entry: UserActivity):
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self._max_users:
+            self._entries.popitem(last=False)
+
+    def _with_pending(self, user_id: int, count: int, total_length: int) -> UserActivity:
+        pending = self._pending.get(user_id, (0, 0))
+        return UserActivity(count + pending[0], total_length + pending[1])
+
+    async def get(self, user_id: int) -> UserActivity:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry.loaded_at < self._snapshot_interval:
+            self._entries.move_to_end(user_id)
+            return entry
+        async with self._lock:
+            async with DB_POOLS.acquire(STATS_DB) as conn:
+                row = await conn.fetchrow(
+                    "SELECT message_count, total_length FROM user_activity_stats WHERE user_id = $1", user_id
+                )
+            entry = self._with_pending(user_id, *(row or (0, 0)))
+        self._put(user_id, entry)
+        return entry
+
+    async def warm(self):
+        """
+        Загружает из БД недавно активных пользователей (не больше max_users).
+        """
+        async with self._lock:
+            async with DB_POOLS.acquire(STATS_DB) as conn:
+                rows = await conn.fetch("""
+                    SELECT user_id, message_count, total_length FROM user_activity_stats
+                    ORDER BY updated_at DESC LIMIT $1;
+                """, self._max_users)
+            # Самые недавние пользователи добавляются последними и вытесняются позже остальных
+            for row in reversed(rows):
+                self._put(row["user_id"], self._with_pending(row["user_id"], row["message_count"], row["total_length"]))
+        logger.info("Статистика активности загружена из БД: %s пользователей", len(rows))
+
+    async def snapshot(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            user_ids = sorted(batch)
+            try:
+                async with DB_POOLS.acquire(STATS_DB) as conn:
+                    await conn.execute("""
+                        INSERT INTO user_activity_stats (user_id, message_count, total_length)
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                        ON CONFLICT (user_id) DO UPDATE
+                        SET message_count = user_activity_stats.message_count + EXCLUDED.message_count,
+                            total_length = user_activity_stats.total_length + EXCLUDED.total_length,
+                            updated_at = now();
+                    """, user_ids, [batch[uid][0] for uid in user_ids], [batch[uid][1] for uid in user_ids])
+            except Exception as e:
+                logger.error("Ошибка сохранения статистики активности пользователей: %s", e)
+                for user_id, (count, total_length) in batch.items():
+                    pending = self._pending.setdefault(user_id, [0, 0])
+                    pending[0] += count
+                    pending[1] += total_length
+
+    async def page(self, offset: int, limit: int):
+        """
+        Возвращает страницу пользователей по убыванию числа сообщений и общее число пользователей.
+        """
+        await self.snapshot()
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            rows = await conn.fetch("""
+                SELECT user_id, message_count, total_length FROM user_activity_stats
+                ORDER BY message_count DESC, user_id LIMIT $1 OFFSET $2;
+            """, limit, offset)
+            total = await conn.fetchval("SELECT COUNT(*) FROM user_activity_stats")
+        return rows, total
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self._snapshot_interval)
+            await self.snapshot()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """
+        Останавливает периодическое сохранение и сохраняет оставшиеся приращения.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.snapshot()
+
+# ----------------------------
+# Дневные роллапы активности Nutsfarm
+# ----------------------------
+
+
+DAILY_ACTIVE_USERS_SQL = """
+SELECT $1::date AS day, user_id, COUNT(*)::int AS tx_count
+FROM user_transaction
+WHERE created_at >= $1::date AND created_at < $1::date + 1
+GROUP BY user_id
+"""
+
+async def rollup_day(day: datetime.date):
+    """
+    Пересчитывает роллапы за один день в одной транзакции: повторный запуск
+    за тот же день безопасен.
+    """
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM nutsfarm_daily_active_users WHERE day = $1", day)
+            async with contextlib.aclosing(stream_records(DAILY_ACTIVE_USERS_SQL, "nutsfarm", (day,),
+                                                          readonly=False)) as chunks:
+                async for chunk in chunks:
+                    await conn.copy_records_to_table(
+                        "nutsfarm_daily_active_users", records=chunk, columns=["day", "user_id", "tx_count"]
+                    )
+            await conn.execute("""
+                INSERT INTO nutsfarm_user_activity (user_id, first_day, last_day)
+                SELECT user_id, day, day FROM nutsfarm_daily_active_users WHERE day = $1
+                ON CONFLICT (user_id) DO UPDATE
+                SET first_day = LEAST(nutsfarm_user_activity.first_day, EXCLUDED.first_day),
+                    last_day = GREATEST(nutsfarm_user_activity.last_day, EXCLUDED.last_day);
+            """, day)
+            await conn.execute("""
+                INSERT INTO rollup_state (name, last_day) VALUES ($1, $2)
+                ON CONFLICT (name) DO UPDATE SET last_day = EXCLUDED.last_day;
+            """, ROLLUP_NAME, day)
+
+async def seconds_until_next_day() -> float:
+    # Граница дня – по часам БД Nutsfarm, как и в refresh_daily_rollups
+    async with DB_POOLS.acquire("nutsfarm") as conn:
+        return await conn.fetchval("SELECT EXTRACT(EPOCH FROM (current_date + 1)::timestamptz - now())::float8")
+
+async def refresh_daily_rollups():
+    """
+    Дополняет роллапы днями, которые ещё не обработаны.
+    Обрабатываются только завершённые дни – до вчерашнего включительно по часам БД Nutsfarm.
+    """
+    if not (DB_POOLS.has("nutsfarm") and DB_POOLS.has(STATS_DB)):
+        return
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        last_day = await conn.fetchval("SELECT last_day FROM rollup_state WHERE name = $1", ROLLUP_NAME)
+    async with DB_POOLS.acquire("nutsfarm") as conn:
+        today = await conn.fetchval("SELECT current_date")
+        if last_day is None:
+            first_day = await conn.fetchval("SELECT MIN(created_at)::date FROM user_transaction")
+            if first_day is None:
+                return
+            last_day = first_day - datetime.timedelta(days=1)
+    day = last_day + datetime.timedelta(days=1)
+    while day < today:
+        await rollup_day(day)
+        logger.info("Роллап активности за %s обновлён", day)
+        day += datetime.timedelta(days=1)
+
+
+class RollupWorker:
+    """
+    Фоновая задача, периодически дополняющая дневные роллапы новыми днями
+    и обслуживающая партиции почасовой истории активности чатов.
+    """
+
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._task = None
+
+    async def run_once(self):
+        try:
+            await refresh_daily_rollups()
+        except Exception as e:
+            logger.error("Ошибка при обновлении роллапов: %s", e)
+        if DB_POOLS.has(STATS_DB):
+            try:
+                await maintain_activity_partitions()
+            except Exception as e:
+                logger.error("Ошибка при обслуживании партиций activity_hourly: %s", e)
+
+    async def _loop(self):
+        while True:
+            try:
+                # При нескольких репликах роллапы и партиции обслуживает одна из них
+                async with cluster_lock("rollups") as acquired:
+                    if acquired:
+                        await self.run_once()
+            except Exception as e:
+                logger.error("Ошибка при получении блокировки роллапов: %s", e)
+            await asyncio.sleep(await self._next_delay())
+
+    async def _next_delay(self) -> float:
+        # Закончившийся день обрабатывается сразу после полуночи, не дожидаясь следующего интервала
+        if not DB_POOLS.has("nutsfarm"):
+            return self._interval
+        try:
+            return min(self._interval, await seconds_until_next_day() + 60)
+        except Exception as e:
+            logger.error("Не удалось определить границу дня для роллапов: %s", e)
+            return self._interval
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+# ----------------------------
+# Очередь отчётов
+# ----------------------------
+
+# Приоритеты заданий: меньшее значение выполняется раньше
+JOB_PRIORITIES = {"kpi": 0, "export": 1, "background": 2}
+
+def get_cancel_keyboard(job_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Отменить", callback_data=f"cancel:{REPLICA_ID}:{job_id}")]
+    ])
+
+
+class ReportJob:
+    """
+    Задание на формирование отчёта. runner(job) – корутина, выполняющая отчёт;
+    ход выполнения показывается в сообщении status_message.
+    """
+
+    def __init__(self, job_id: int, user_id: int, name: str, db_instance: str, priority: int, runner):
+        self.id = job_id
+        self.user_id = user_id
+        self.name = name
+        self.db_instance = db_instance
+        self.priority = priority
+        self.runner = runner
+        self.task = None
+        self.status_message = None
+        self.created_at = time.monotonic()
+        self._status_text = None
+        self._progress_at = 0.0
+
+    def sort_key(self):
+        return (self.priority, self.id)
+
+    async def set_status(self, text: str, cancellable: bool = True):
+        # Повторная правка тем же текстом – лишний запрос к Telegram
+        if self.status_message is None or text == self._status_text:
+            return
+        self._status_text = text
+        markup = get_cancel_keyboard(self.id) if cancellable else None
+        with contextlib.suppress(TelegramBadRequest):
+            await self.status_message.edit_text(text, reply_markup=markup)
+
+    async def progress(self, rows_count: int):
+        now = time.monotonic()
+        if self.task is None or self.task.done() or now - self._progress_at < JOB_PROGRESS_INTERVAL:
+            return
+        self._progress_at = now
+        await self.set_status(f"Выполняется запрос «{self.name}»: получено {rows_count} строк...")
+
+
+class ReportScheduler:
+    """
+    Очередь отчётов с ограничением числа одновременных запросов к каждой БД.
+    Внутри очереди одной БД задания упорядочены по приоритету, затем по времени постановки.
+    """
+
+    def __init__(self, limits: dict, default_limit: int):
+        self._limits = limits
+        self._default_limit = default_limit
+        self._queues = {}
+        self._running = {}
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._notices = set()
+
+    def create_job(self, user_id: int, name: str, db_instance: str, kind: str, runner) -> ReportJob:
+        priority = JOB_PRIORITIES.get(kind, JOB_PRIORITIES["kpi"])
+        return ReportJob(next(self._ids), user_id, name, db_instance, priority, runner)
+
+    def get(self, job_id: int):
+        return self._jobs.get(job_id)
+
+    def position(self, job: ReportJob) -> int:
+        queue = self._queues.get(job.db_instance, [])
+        return queue.index(job) + 1 if job in queue else 0
+
+    async def submit(self, job: ReportJob):
+        self._jobs[job.id] = job
+        bisect.insort(self._queues.setdefault(job.db_instance, []), job, key=ReportJob.sort_key)
+        self._dispatch(job.db_instance)
+        await self.announce(job.db_instance)
+
+    async def announce(self, db_instance: str):
+        """
+        Сообщает ожидающим заданиям их текущую позицию в очереди.
+        """
+        for position, job in enumerate(list(self._queues.get(db_instance, [])), start=1):
+            await job.set_status(f"Запрос «{job.name}» в очереди. Позиция: {position}")
+
+    def _dispatch(self, db_instance: str):
+        queue = self._queues.get(db_instance, [])
+        running = self._running.setdefault(db_instance, set())
+        limit = self._limits.get(db_instance, self._default_limit)
+        while queue and len(running) < limit:
+            job = queue.pop(0)
+            running.add(job)
+            job.task = asyncio.create_task(self._run(job))
+            # Слот освобождается по завершении задачи, а не в _run: задача, отменённая
+            # до начала выполнения, не выполнит ни одной строки _run
+            job.task.add_done_callback(functools.partial(self._release, job))
+
+    def _release(self, job: ReportJob, task: asyncio.Task):
+        self._running[job.db_instance].discard(job)
+        self._jobs.pop(job.id, None)
+        if task.cancelled():
+            logger.info("Задание %s (%s) отменено до начала выполнения", job.id, job.name)
+            notice = asyncio.create_task(job.set_status(f"Запрос «{job.name}» отменён.", cancellable=False))
+            self._notices.add(notice)
+            notice.add_done_callback(self._notices.discard)
+        self._dispatch(job.db_instance)
+
+    async def _run(self, job: ReportJob):
+        try:
+            METRICS.observe("report_queue_wait_seconds", time.monotonic() - job.created_at, db=job.db_instance)
+            await self.announce(job.db_instance)
+            await job.set_status(f"Выполняется запрос «{job.name}»...")
+            with METRICS.timer("report_duration_seconds", db=job.db_instance):
+                await job.runner(job)
+            if job.status_message is not None:
+                with contextlib.suppress(TelegramBadRequest):
+                    await job.status_message.delete()
+        except asyncio.CancelledError:
+            logger.info("Задание %s (%s) отменено", job.id, job.name)
+            await job.set_status(f"Запрос «{job.name}» отменён.", cancellable=False)
+        except Exception as e:
+            logger.error("Ошибка при выполнении задания %s: %s", job.id, e)
+            await job.set_status(f"Запрос «{job.name}» завершился с ошибкой.", cancellable=False)
+
+    async def cancel(self, job: ReportJob):
+        """
+        Отменяет задание: ожидающее удаляется из очереди, выполняющееся прерывается.
+        """
+        queue = self._queues.get(job.db_instance, [])
+        if job in queue:
+            queue.remove(job)
+            self._jobs.pop(job.id, None)
+            await job.set_status(f"Запрос «{job.name}» отменён.", cancellable=False)
+            await self.announce(job.db_instance)
+        elif job.task is not None:
+            job.task.cancel()
+
+    async def close(self):
+        self._queues.clear()
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def can_cancel_job(job: ReportJob, user_id: int) -> bool:
+    return job.user_id == user_id or get_user_department(user_id) == "admin"
+
+
+class CancelRelay:
+    """
+    Пересылка отмены заданий между репликами через LISTEN/NOTIFY в БД статистики:
+    нажатие кнопки отмены может прийти в любую реплику, а задание выполняется в создавшей его.
+    """
+
+    CHANNEL = "report_cancel"
+
+    def __init__(self, scheduler: ReportScheduler, dsn: str, check_interval: float = 30):
+        self._scheduler = scheduler
+        self._dsn = dsn
+        self._check_interval = check_interval
+        self._conn = None
+        self._task = None
+        self._cancellations = set()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        message = json.loads(payload)
+        if message["replica"] != REPLICA_ID:
+            return
+        job = self._scheduler.get(message["job_id"])
+        if job is None or not can_cancel_job(job, message["user_id"]):
+            return
+        task = asyncio.create_task(self._scheduler.cancel(job))
+        self._cancellations.add(task)
+        task.add_done_callback(self._cancellations.discard)
+        logger.info("Пользователь %s отменил задание %s через другую реплику", message["user_id"], job.id)
+
+    async def _loop(self):
+        # Соединение слушателя восстанавливается после обрыва
+        while True:
+            if self._conn is None or self._conn.is_closed():
+                try:
+                    self._conn = await asyncpg.connect(self._dsn)
+                    await self._conn.add_listener(self.CHANNEL, self._on_notify)
+                except Exception as e:
+                    logger.error("Не удалось подписаться на отмену заданий: %s", e)
+            await asyncio.sleep(self._check_interval)
+
+    async def publish(self, replica: str, job_id: int, user_id: int):
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", self.CHANNEL,
+                               json.dumps({"replica": replica, "job_id": job_id, "user_id": user_id}))
+
+    def start(self):
+        if self._task is None and self._dsn:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._conn is not None:
+            with contextlib.suppress(Exception):
+                await self._conn.close()
+            self._conn = None
+
+# ----------------------------
+# Подготовка отчётов по расписанию и подписки
+# ----------------------------
+
+def parse_schedule_time(value: str) -> datetime.time:
+    return datetime.datetime.strptime(value.strip(), "%H:%M").time()
+
+
+class ReportPlanner:
+    """
+    Раз в минуту ставит в очередь отчётов фоновые задания:
+    - заблаговременную подготовку отчётов с параметром pregenerate;
+    - доставку отчётов подписчикам в выбранное ими время.
+    """
+
+    def __init__(self, bot: Bot, interval: float = 60):
+        self._bot = bot
+        self._interval = interval
+        self._pregenerated = {}
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error("Ошибка планировщика отчётов: %s", e)
+            await asyncio.sleep(self._interval)
+
+    async def tick(self):
+        now = datetime.datetime.now(SCHEDULE_TIMEZONE)
+        await self._pregenerate_due(now)
+        await self._deliver_subscriptions(now)
+
+    async def _pregenerate_due(self, now: datetime.datetime):
+        for route in SERVICE_REGISTRY.routes():
+            service_id, query_config = route.service_id, route.config
+            # Запрос с параметрами готовится заранее со значениями по умолчанию
+            params = route.defaults()
+            if not query_config.get("pregenerate") or params is None:
+                continue
+            key = (service_id, query_config["callback"])
+            due = parse_schedule_time(query_config["pregenerate"]) <= now.time()
+            if key not in self._pregenerated:
+                # Пропущенный до запуска бота слот не догоняем: тяжёлый запрос должен идти в тихие часы
+                self._pregenerated[key] = now.date() if due else None
+                continue
+            if not due or self._pregenerated[key] == now.date():
+                continue
+            self._pregenerated[key] = now.date()
+            # Тяжёлый запрос заранее выполняет одна реплика, и результат остаётся в её кэше.
+            # Остальные реплики выполняют запрос сами (с ARTIFACT_CHAT_ID файл с теми же данными
+            # повторно не загружается, но для сравнения данных запрос всё равно нужен)
+            if not await claim_scheduled_run(f"pregenerate:{service_id}:{query_config['callback']}", now.date()):
+                continue
+            job = REPORT_SCHEDULER.create_job(
+                0, query_config["name"], query_config["db_instanse"], "background",
+                functools.partial(pregenerate_report, bot=self._bot, service_id=service_id,
+                                  query_key=query_config["callback"], query_config=query_config, params=params),
+            )
+            await REPORT_SCHEDULER.submit(job)
+            logger.info("Запланирована подготовка отчёта %s сервиса %s", query_config["name"], service_id)
+
+    async def _deliver_subscriptions(self, now: datetime.datetime):
+        if not DB_POOLS.has(STATS_DB):
+            return
+        # Подписка помечается отправленной в том же запросе, поэтому за день она выбирается один раз
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            rows = await conn.fetch("""
+                UPDATE report_subscriptions SET last_sent = $1
+                WHERE deliver_at <= $2 AND (last_sent IS NULL OR last_sent < $1)
+                RETURNING user_id, service_id, callback, export_format;
+            """, now.date(), now.time().replace(tzinfo=None))
+        for row in rows:
+            route = SERVICE_REGISTRY.find_route(row["service_id"], row["callback"])
+            # Подписка выполняет запрос со значениями параметров по умолчанию
+            params = route.defaults() if route is not None else None
+            if params is None or not user_has_service(row["user_id"], row["service_id"]):
+                logger.warning("Подписка %s пользователя %s недоступна, пропускаем", row["callback"], row["user_id"])
+                continue
+            query_config = route.config
+            job = REPORT_SCHEDULER.create_job(
+                row["user_id"], query_config["name"], query_config["db_instanse"], query_config.get("kind", "kpi"),
+                functools.partial(run_report, bot=self._bot, chat_id=row["user_id"], service_id=row["service_id"],
+                                  query_key=row["callback"], query_config=query_config, params=params,
+                                  export_format=row["export_format"] if row["export_format"] in EXPORT_FORMATS else "csv"),
+            )
+            await REPORT_SCHEDULER.submit(job)
+            logger.info("Запланирована доставка отчёта %s пользователю %s", query_config["name"], row["user_id"])
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+# ----------------------------
+# FSM для выбора сервиса
+# ----------------------------
+
+class ServiceSelection(StatesGroup):
+    waiting_for_service = State()
+
+class SubscriptionSetup(StatesGroup):
+    waiting_for_time = State()
+
+class QueryParams(StatesGroup):
+    waiting_for_value = State()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в БД статистики: состояние диалога и его данные
+    (формат выгрузки, параметры подписки) видны всем репликам бота.
+    Диалоги есть только у пользователей с доступом к боту, поэтому для остальных
+    (участников групповых чатов) БД не запрашивается.
+    """
+
+    def __init__(self, users):
+        self._users = users
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+                 getattr(key, "business_connection_id", None) or "", key.destiny)
+        return ":".join(map(str, parts))
+
+    async def set_state(self, key: StorageKey, state=None):
+        value = state.state if isinstance(state, State) else state
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            await conn.execute("""
+                INSERT INTO fsm_storage (storage_key, state) VALUES ($1, $2)
+                ON CONFLICT (storage_key) DO UPDATE SET state = EXCLUDED.state, updated_at = now();
+            """, self._key(key), value)
+
+    async def get_state(self, key: StorageKey):
+        if key.user_id not in self._users:
+            return None
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            return await conn.fetchval("SELECT state FROM fsm_storage WHERE storage_key = $1", self._key(key))
+
+    async def set_data(self, key: StorageKey, data):
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            await conn.execute("""
+                INSERT INTO fsm_storage (storage_key, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (storage_key) DO UPDATE SET data = EXCLUDED.data, updated_at = now();
+            """, self._key(key), json.dumps(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        if key.user_id not in self._users:
+            return {}
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            data = await conn.fetchval("SELECT data FROM fsm_storage WHERE storage_key = $1", self._key(key))
+        return json.loads(data) if data else {}
+
+    async def update_data(self, key: StorageKey, data) -> dict:
+        # Слияние в одном запросе: одновременные обновления с разных реплик не затирают друг друга
+        async with DB_POOLS.acquire(STATS_DB) as conn:
+            merged = await conn.fetchval("""
+                INSERT INTO fsm_storage (storage_key, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (storage_key) DO UPDATE SET data = fsm_storage.data || EXCLUDED.data, updated_at = now()
+                RETURNING data;
+            """, self._key(key), json.dumps(dict(data)))
+        return json.loads(merged)
+
+    async def close(self):
+        # Соединения принадлежат реестру пулов и закрываются вместе с ним
+        pass
+
+# ----------------------------
+# Хэндлеры
+# ----------------------------
+
+async def start_handler(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    if user_id not in ALLOWED_USERS:
+        await message.answer("У вас нет доступа к этому боту.")
+        logger.warning("Попытка доступа неавторизованного пользователя: %s", user_id)
+        return
+
+    dept = get_user_department(user_id)
+    keyboard = get_reply_keyboard_for_services(dept)
+    await message.answer("Добро пожаловать!\nВыберите сервис:", reply_markup=keyboard)
+    logger.info("Пользователь %s (отдел %s) запустил бота", user_id, dept)
+    # Устанавливаем состояние для выбора сервиса
+    await state.set_state(ServiceSelection.waiting_for_service)
+
+async def service_selection_handler(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    dept = get_user_department(user_id)
+    service = get_service_by_name(dept, message.text.strip())
+    if not service:
+        await message.answer("Неизвестный сервис. Пожалуйста, выберите сервис с клавиатуры.")
+        return
+    inline_kb = get_inline_keyboard_for_service(service["id"])
+    await message.answer(f"Сервис «{service['name']}». Выберите запрос:", reply_markup=inline_kb)
+    logger.info("Пользователь %s выбрал сервис %s", user_id, service["name"])
+    # Сбрасываем состояние после выбора сервиса (данные, например формат выгрузки, сохраняются)
+    await state.set_state(None)
+
+# Форматы выгрузки: код -> (название, функция кодирования spool-файла, расширение файла)
+EXPORT_FORMATS = {
+    "csv": ("CSV", generate_csv, "csv"),
+    "parquet": ("Parquet", generate_parquet, "parquet"),
+    "xlsx": ("Excel", generate_excel, "xlsx"),
+}
+
+def get_format_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=f"fmt:{code}")]
+        for code, (label, _, _) in EXPORT_FORMATS.items()
+    ])
+
+async def run_report(job: ReportJob, bot: Bot, chat_id: int, service_id: str, query_key: str, query_config: dict,
+                     export_format: str = "csv", delta: bool = False, params: tuple = ()):
+    """
+    Выполняет запрос отчёта со значениями параметров params и отправляет результат в чат chat_id.
+    С delta=True выгружаются только строки, появившиеся после прошлой такой выгрузки пользователя.
+    Вызывается очередью отчётов как runner задания.
+    """
+    user_id = job.user_id
+    db_instance = query_config["db_instanse"]
+    base_name = f"{service_id}_{query_key}" + ("_delta" if delta else "")
+    caption = f"Отчет: {query_config['name']}" + (" (новые строки)" if delta else "")
+    if params:
+        base_name += "_" + "_".join(re.sub(r"[^\w.-]+", "_", str(value)) for value in params)
+        caption += f" ({SERVICE_REGISTRY.find_route(service_id, query_key).describe(params)})"
+    format_label, encoder, extension = EXPORT_FORMATS[export_format]
+    async with contextlib.AsyncExitStack() as stack:
+        tmp_dir = tempfile.mkdtemp(prefix="report_", dir=REPORTS_TMP_DIR)
+        stack.callback(shutil.rmtree, tmp_dir, ignore_errors=True)
+        try:
+            if delta:
+                # Новые строки свои у каждого пользователя, поэтому кэш результатов не используется
+                since = await get_export_watermark(user_id, service_id, query_key)
+                spool_path = os.path.join(tmp_dir, "delta.spool")
+                columns, rows_count, digest, watermark = await load_delta_to_spool(
+                    query_config, db_instance, spool_path, since, progress=job.progress
+                )
+                result = CachedResult(spool_path, columns, rows_count, digest)
+            else:
+                # Результат берётся из кэша, а одинаковые одновременные запросы выполняются один раз
+                result = await stack.enter_async_context(RESULT_CACHE.use(
+                    result_cache_key(query_config, params),
+                    query_config.get("cache_ttl", 0),
+                    functools.partial(load_query_to_spool, query_config["sql"], db_instance, progress=job.progress,
+                                      timeout=query_timeout(query_config), args=params),
+                ))
+            logger.info("Данные успешно получены для запроса %s сервиса %s пользователем %s (%s строк)",
+                        query_config["name"], service_id, user_id, result.rows_count)
+        except QueryTimeoutError as e:
+            logger.error("Запрос %s прерван по времени: %s", query_config["name"], e)
+            METRICS.inc("report_errors_total", stage="timeout")
+            await bot.send_message(
+                chat_id,
+                f"Запрос «{query_config['name']}» прерван: он выполнялся дольше допустимых {e.timeout:g} с. "
+                "Попробуйте позже или обратитесь к администратору, чтобы ускорить запрос."
+            )
+            return
+        except QueryError as e:
+            logger.error("Ошибка при выполнении запроса: %s", e)
+            METRICS.inc("report_errors_total", stage="query")
+            await bot.send_message(chat_id, "Ошибка при выполнении запроса к базе данных.")
+            return
+        except Exception as e:
+            logger.error("Ошибка при выгрузке данных запроса: %s", e)
+            METRICS.inc("report_errors_total", stage="query")
+            await bot.send_message(chat_id, f"Ошибка при генерации {format_label} файла.")
+            return
+
+        if delta and not result.rows_count:
+            await bot.send_message(chat_id, f"Новых строк в отчёте «{query_config['name']}» с прошлой выгрузки нет.")
+            return
+
+        # Одинаковый отчёт (те же данные) отправляется по file_id без повторной загрузки
+        file_key = f"{base_name}.{extension}:{result.digest}"
+        file_ids = await FILE_ID_CACHE.get(file_key)
+        if file_ids:
+            try:
+                for number, file_id in enumerate(file_ids, 1):
+                    part_caption = caption if len(file_ids) == 1 else f"{caption} (часть {number} из {len(file_ids)})"
+                    await bot.send_document(chat_id, document=file_id, caption=part_caption)
+                logger.info("%s-файл отправлен в чат %s по сохранённому file_id", format_label, chat_id)
+                METRICS.inc("report_file_id_sends_total", format=export_format)
+            except Exception as e:
+                logger.warning("Не удалось отправить отчёт по file_id, файл будет загружен заново: %s", e)
+                await FILE_ID_CACHE.discard(file_key)
+                file_ids = None
+
+        if not file_ids:
+            await job.set_status(f"Формирую отчет «{query_config['name']}», подождите...")
+            # Parquet уже сжат по колонкам, кодек подбирается только для CSV:
+            # размер CSV оценивается по размеру spool-файла
+            codec = choose_codec(result.size) if export_format == "csv" else None
+            options = {"codec": codec} if codec is not None else {}
+            part_extension = "zip" if codec is not None else extension
+            # Загрузка части начинается сразу после её формирования, пока кодируется следующая.
+            # Новая часть формируется, только когда освобождается место среди загружаемых
+            upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+            uploads = []
+
+            async def upload(path: str, filename: str, part_caption: str):
+                try:
+                    with METRICS.timer("report_upload_seconds", format=export_format):
+                        sent = await bot.send_document(
+                            chat_id,
+                            document=FSInputFile(path, filename=filename),
+                            caption=part_caption
+                        )
+                    return sent.document.file_id
+                finally:
+                    os.remove(path)
+                    upload_slots.release()
+
+            try:
+                offset = 0
+                while offset is not None:
+                    part_offset = offset
+                    await upload_slots.acquire()
+                    number = len(uploads) + 1
+                    suffix = f"_part{number}" if number > 1 else ""
+                    try:
+                        # Кодирование и сжатие выполняются в пуле отчётов, цикл событий остаётся свободным
+                        with METRICS.timer("report_encode_seconds", format=export_format,
+                                           codec=codec.name if codec is not None else "none"):
+                            file_path, offset = await REPORT_EXECUTOR.run(
+                                encoder, result.path, result.columns,
+                                os.path.join(tmp_dir, f"{base_name}{suffix}.{part_extension}"),
+                                offset=offset, max_bytes=EXPORT_PART_SIZE, **options
+                            )
+                        METRICS.observe("report_file_bytes", os.path.getsize(file_path), format=export_format)
+                        if encoder is generate_excel and offset is not None:
+                            # Размер XLSX известен только после сохранения: следующая часть
+                            # оценивается по отношению, измеренному на этой
+                            options["size_ratio"] = (
+                                os.path.getsize(file_path) / (offset - part_offset) * EXCEL_SIZE_MARGIN
+                            )
+                    except Exception as e:
+                        upload_slots.release()
+                        METRICS.inc("report_errors_total", stage="encode")
+                        logger.error("Ошибка при генерации %s-файла: %s", format_label, e)
+                        await bot.send_message(chat_id, f"Ошибка при генерации {format_label} файла.")
+                        return
+                    if offset is None and number == 1:
+                        filename, part_caption = f"{base_name}.{part_extension}", caption
+                    else:
+                        # Общее число частей известно только при формировании последней
+                        filename = f"{base_name}_part{number}.{part_extension}"
+                        total = f" из {number}" if offset is None else ""
+                        part_caption = f"{caption} (часть {number}{total})"
+                        await job.set_status(f"Формирую отчет «{query_config['name']}», сформировано частей: {number}...")
+                    if codec is not None and number == 1:
+                        logger.info("Отчёт %s сжат кодеком %s", base_name, codec.name)
+                    uploads.append(asyncio.create_task(upload(file_path, filename, part_caption)))
+
+                try:
+                    file_ids = list(await asyncio.gather(*uploads))
+                except Exception as e:
+                    logger.error("Ошибка при отправке файла: %s", e)
+                    METRICS.inc("report_errors_total", stage="upload")
+                    await bot.send_message(chat_id, "Ошибка при отправке файла.")
+                    return
+                logger.info("%s-файл отправлен в чат %s (частей: %s)", format_label, chat_id, len(file_ids))
+                await FILE_ID_CACHE.put(file_key, file_ids)
+            finally:
+                # При ошибке или отмене задания незавершённые загрузки прерываются
+                for task in uploads:
+                    task.cancel()
+                await asyncio.gather(*uploads, return_exceptions=True)
+
+        # Отметка сдвигается только после того, как пользователь получил строки
+        if delta and watermark is not None:
+            await set_export_watermark(user_id, service_id, query_key, watermark)
+
+async def pregenerate_report(job: ReportJob, bot: Bot, service_id: str, query_key: str, query_config: dict,
+                             params: tuple = ()):
+    """
+    Заранее выполняет запрос и оставляет результат в кэше этого процесса до следующей подготовки.
+    Если задан ARTIFACT_CHAT_ID, отчёт сразу загружается в служебный чат, и пользователи
+    этого процесса затем получают его по file_id без ожидания запроса и загрузки.
+    """
+    db_instance = query_config["db_instanse"]
+    stored = await RESULT_CACHE.preload(
+        result_cache_key(query_config, params),
+        PREGENERATE_TTL,
+        functools.partial(load_query_to_spool, query_config["sql"], db_instance, timeout=query_timeout(query_config),
+                          args=params),
+    )
+    if stored:
+        logger.info("Отчёт %s сервиса %s подготовлен заранее", query_config["name"], service_id)
+    # Несохранённый результат пришлось бы получать повторным запросом
+    if ARTIFACT_CHAT_ID and stored:
+        await run_report(job, bot, ARTIFACT_CHAT_ID, service_id, query_key, query_config, params=params)
+
+async def preflight_query(user_id: int, service_id: str, query_config: dict, delta: bool = False,
+                          params: tuple = ()) -> str:
+    """
+    Оценивает запрос через EXPLAIN до постановки в очередь и сравнивает оценку с бюджетом запроса.
+    Возвращает "ok", "background" (бюджет превышен) или "rejected" (превышен в QUERY_REJECT_FACTOR раз;
+    выгрузки не отклоняются, а выполняются в фоне).
+    """
+    db_instance = query_config["db_instanse"]
+    try:
+        if delta:
+            since = await get_export_watermark(user_id, service_id, query_config["callback"])
+            sql, args = delta_query(query_config["sql"], query_config["watermark"],
+                                    query_config.get("watermark_type", "bigint"), since)
+        else:
+            sql, args = query_config["sql"], params
+        cost, rows = await explain_query(sql, db_instance, args)
+    except Exception as e:
+        # Оценка не обязательна: ошибку самого запроса пользователь увидит при его выполнении
+        logger.warning("Не удалось оценить запрос %s: %s", query_config["name"], e)
+        return "ok"
+    overrun = budget_overrun(query_config, cost, rows)
+    if overrun > QUERY_REJECT_FACTOR and query_config.get("kind", "kpi") != "export":
+        logger.warning("Запрос %s отклонён: стоимость %.0f, строк %s", query_config["name"], cost, rows)
+        return "rejected"
+    if overrun > 1:
+        logger.info("Запрос %s превышает бюджет (стоимость %.0f, строк %s), выполнится в фоне",
+                    query_config["name"], cost, rows)
+        return "background"
+    return "ok"
+
+async def query_callback_handler(callback: types.CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    prefix, _, query_id = callback.data.partition(":")
+    route = SERVICE_REGISTRY.route(query_id) if prefix in ("q", "qd") else None
+    if route is None:
+        # Кнопки сообщений, отправленных до компактных идентификаторов: "service_id:callback"
+        route = SERVICE_REGISTRY.find_route(prefix, query_id)
+    delta = prefix == "qd"
+    if route is None:
+        await callback.answer("Запрос не найден.")
+        logger.warning("Запрос не найден для callback data: %s", callback.data)
+        return
+    service_id, query_config = route.service_id, route.config
+    if not user_has_service(user_id, service_id):
+        await callback.answer("У вас нет доступа к этому отчёту.")
+        return
+
+    await callback.answer("Обработка запроса...")
+
+    # Выбор экземпляра БД по параметру из запроса
+    db_instance = query_config.get("db_instanse")
+    if not db_instance:
+        await callback.message.answer("Запрос не настроен: не указан экземпляр БД.")
+        logger.error("Нет параметра db_instanse для запроса %s", query_config["name"])
+        return
+
+    if not DB_POOLS.has(db_instance):
+        await callback.message.answer("Нет настроенной базы данных для данного запроса.")
+        logger.error("Нет БД для db_instanse: %s", db_instance)
+        return
+
+    # Отметки выгрузок хранятся в БД статистики
+    if delta and (not query_config.get("watermark") or not DB_POOLS.has(STATS_DB)):
+        await callback.message.answer("Выгрузка только новых строк для этого запроса недоступна.")
+        return
+
+    if route.params:
+        # Значения параметров запрашиваются по одному, после последнего отчёт ставится в очередь
+        await state.set_state(QueryParams.waiting_for_value)
+        await state.update_data(param_route=route.id, param_values=[])
+        await callback.message.answer(route.params[0].prompt())
+        return
+    await submit_report(callback.message, state, user_id, route, delta=delta)
+
+async def submit_report(message: types.Message, state: FSMContext, user_id: int, route: QueryRoute,
+                        delta: bool = False, params: tuple = ()):
+    """
+    Оценивает запрос и ставит отчёт в очередь; ход выполнения показывается в чате сообщения message.
+    """
+    service_id, query_config = route.service_id, route.config
+    kind = query_config.get("kind", "kpi")
+    # Результату из кэша обращение к БД не нужно, поэтому оценка выполняется только для новых запросов
+    if delta or not RESULT_CACHE.has(result_cache_key(query_config, params)):
+        verdict = await preflight_query(user_id, service_id, query_config, delta, params)
+        METRICS.inc("report_preflight_total", verdict=verdict)
+        if verdict == "rejected":
+            await message.answer(
+                f"Запрос «{query_config['name']}» отклонён: по оценке планировщика он слишком тяжёлый "
+                "для выполнения по запросу. Обратитесь к администратору, чтобы ускорить запрос или увеличить его лимит."
+            )
+            return
+        if verdict == "background":
+            kind = "background"
+
+    export_format = (await state.get_data()).get("export_format", "csv")
+    job = REPORT_SCHEDULER.create_job(
+        user_id, query_config["name"], query_config["db_instanse"], kind,
+        functools.partial(run_report, bot=message.bot, chat_id=message.chat.id,
+                          service_id=service_id, query_key=query_config["callback"], query_config=query_config,
+                          export_format=export_format, delta=delta, params=params),
+    )
+    accepted = f"Запрос «{query_config['name']}» принят."
+    if kind == "background":
+        accepted += " Запрос тяжёлый и выполнится в фоновой очереди, после остальных отчётов."
+    job.status_message = await message.answer(accepted, reply_markup=get_cancel_keyboard(job.id))
+    await REPORT_SCHEDULER.submit(job)
+    await state.set_state(ServiceSelection.waiting_for_service)
+
+async def query_param_handler(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    data = await state.get_data()
+    route = SERVICE_REGISTRY.route(data.get("param_route") or "")
+    if route is None or not user_has_service(user_id, route.service_id):
+        await state.set_state(ServiceSelection.waiting_for_service)
+        await message.answer("Запрос не найден. Выберите сервис с клавиатуры.")
+        return
+    text = (message.text or "").strip()
+    # Выбор сервиса на клавиатуре прерывает ввод параметров
+    if get_service_by_name(get_user_department(user_id), text):
+        await state.set_state(ServiceSelection.waiting_for_service)
+        await service_selection_handler(message, state)
+        return
+
+    # Введённые ранее значения хранятся в данных FSM строками
+    values = [param.parse(raw) for param, raw in zip(route.params, data.get("param_values") or [])]
+    param = route.params[len(values)]
+    try:
+        value = param.parse(param.default if text == "-" and param.default is not None else text)
+        if param.after is not None:
+            index = next(i for i, other in enumerate(route.params) if other.name == param.after)
+            if value < values[index]:
+                raise ValueError(f"не может быть меньше, чем «{route.params[index].label}»")
+    except ValueError as e:
+        await message.answer(f"Неверное значение: {e}. {param.prompt()}")
+        return
+    values.append(value)
+    if len(values) < len(route.params):
+        await state.update_data(param_values=[str(value) for value in values])
+        await message.answer(route.params[len(values)].prompt())
+        return
+
+    data.pop("param_route", None)
+    data.pop("param_values", None)
+    await state.set_data(data)
+    await submit_report(message, state, user_id, route, params=tuple(values))
+
+
+# Сводка отправляется сообщением, только если помещается в одно сообщение Telegram
+DASHBOARD_MESSAGE_LIMIT = 4000
+
+def format_kpi_value(value) -> str:
+    if value is None:
+        return "—"
+    if isinstance(value, bool):
+        return "да" if value else "нет"
+    if isinstance(value, int):
+        return f"{value:,}".replace(",", " ")
+    if isinstance(value, (float, decimal.Decimal)):
+        return f"{value:,.2f}".replace(",", " ")
+    return str(value)
+
+def describe_dashboard_error(error: BaseException) -> str:
+    if isinstance(error, QueryTimeoutError):
+        return f"превышено время ({error.timeout:g} с)"
+    if isinstance(error, QueryError):
+        return "ошибка запроса"
+    return "ошибка"
+
+async def load_dashboard_part(job: ReportJob, stack: contextlib.AsyncExitStack, route: QueryRoute,
+                              future: asyncio.Future):
+    """
+    Runner задания одного отчёта сводки: получает результат через кэш результатов и передаёт его в future.
+    Результат удерживается стеком stack сводки, пока сводка не отправлена.
+    """
+    query_config, params = route.config, route.defaults()
+    try:
+        result = await stack.enter_async_context(RESULT_CACHE.use(
+            result_cache_key(query_config, params),
+            query_config.get("cache_ttl", 0),
+            functools.partial(load_query_to_spool, query_config["sql"], query_config["db_instanse"],
+                              timeout=query_timeout(query_config), args=params),
+        ))
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    future.set_result(result)
+
+def dashboard_summary(service_name: str, parts: list, failures: list):
+    """
+    Текст сводки, если каждый отчёт вернул не больше одной строки, иначе None.
+    parts – список (маршрут, результат), failures – список (маршрут, причина).
+    """
+    if any(result.rows_count > 1 for _, result in parts):
+        return None
+    lines = [f"Сводка «{service_name}»"]
+    for route, result in parts:
+        chunk = next(iter_spool(result.path), ([], None))[0]
+        if not chunk:
+            lines.append(f"{route.config['name']}: нет данных")
+        elif len(result.columns) == 1:
+            lines.append(f"{route.config['name']}: {format_kpi_value(chunk[0][0])}")
+        else:
+            lines.append(f"{route.config['name']}:")
+            lines.extend(f"  {column}: {format_kpi_value(value)}" for column, value in zip(result.columns, chunk[0]))
+    lines.extend(f"{route.config['name']}: не выполнен, {reason}" for route, reason in failures)
+    text = "\n".join(lines)
+    return text if len(text) <= DASHBOARD_MESSAGE_LIMIT else None
+
+async def run_dashboard(message: types.Message, user_id: int, service_id: str):
+    """
+    Выполняет все показатели сервиса одновременно – через очередь отчётов, поэтому с её ограничением
+    на каждую БД – и отправляет их одним сообщением (если каждый вернул не больше строки)
+    или книгой XLSX с листом на отчёт.
+    """
+    routes = SERVICE_REGISTRY.dashboard_routes(service_id)
+    service_name = SERVICE_REGISTRY.service_name(service_id)
+    status = await message.answer(f"Формирую сводку «{service_name}»: отчётов {len(routes)}...")
+
+    async def preflight(route: QueryRoute) -> str:
+        # Результату из кэша обращение к БД не нужно
+        if RESULT_CACHE.has(result_cache_key(route.config, route.defaults())):
+            return "ok"
+        verdict = await preflight_query(user_id, service_id, route.config, params=route.defaults())
+        METRICS.inc("report_preflight_total", verdict=verdict)
+        return verdict
+
+    failures = {}
+    results = {}
+    futures = {}
+    jobs = []
+    with METRICS.timer("dashboard_duration_seconds", service=service_id):
+        async with contextlib.AsyncExitStack() as stack:
+            tmp_dir = tempfile.mkdtemp(prefix="dashboard_", dir=REPORTS_TMP_DIR)
+            stack.callback(shutil.rmtree, tmp_dir, ignore_errors=True)
+            try:
+                verdicts = await asyncio.gather(*(preflight(route) for route in routes))
+                for route, verdict in zip(routes, verdicts):
+                    if verdict == "rejected":
+                        failures[route.id] = "слишком тяжёлый запрос"
+                        continue
+                    future = asyncio.get_running_loop().create_future()
+                    job = REPORT_SCHEDULER.create_job(
+                        user_id, route.config["name"], route.config["db_instanse"],
+                        "background" if verdict == "background" else route.config.get("kind", "kpi"),
+                        functools.partial(load_dashboard_part, stack=stack, route=route, future=future),
+                    )
+                    futures[future] = route
+                    jobs.append(job)
+                    await REPORT_SCHEDULER.submit(job)
+
+                pending = set(futures)
+                while pending:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in finished:
+                        route = futures[future]
+                        if future.cancelled():
+                            failures[route.id] = "отменён"
+                        elif future.exception() is not None:
+                            logger.error("Отчёт %s сводки %s не выполнен: %s",
+                                         route.config["name"], service_id, future.exception())
+                            failures[route.id] = describe_dashboard_error(future.exception())
+                        else:
+                            results[route.id] = future.result()
+                    with contextlib.suppress(TelegramBadRequest):
+                        await status.edit_text(f"Формирую сводку «{service_name}»: "
+                                               f"готово {len(results) + len(failures)} из {len(routes)}...")
+            finally:
+                # Незавершённые отчёты отменяются до закрытия стека, удерживающего результаты
+                for job in jobs:
+                    if REPORT_SCHEDULER.get(job.id) is job:
+                        await REPORT_SCHEDULER.cancel(job)
+
+            parts = [(route, results[route.id]) for route in routes if route.id in results]
+            failed = [(route, failures[route.id]) for route in routes if route.id in failures]
+            logger.info("Сводка %s для пользователя %s: выполнено %s, с ошибкой %s",
+                        service_id, user_id, len(parts), len(failed))
+            with contextlib.suppress(TelegramBadRequest):
+                await status.delete()
+            if not parts:
+                await message.answer(f"Сводка «{service_name}» не сформирована:\n" + "\n".join(
+                    f"{route.config['name']}: {reason}" for route, reason in failed
+                ))
+                return
+            text = dashboard_summary(service_name, parts, failed)
+            if text is not None:
+                await message.answer(text)
+                return
+
+            caption = f"Сводка: {service_name}"
+            filename = f"{service_id}_dashboard.xlsx"
+            # Та же книга (те же данные всех отчётов) отправляется по file_id без повторной загрузки
+            digest = hashlib.sha256(":".join(f"{route.id}={result.digest}" for route, result in parts).encode()).hexdigest()
+            file_key = f"{filename}:{digest}"
+            file_ids = await FILE_ID_CACHE.get(file_key)
+            try:
+                if file_ids:
+                    await message.answer_document(file_ids[0], caption=caption)
+                else:
+                    sheets = [(route.config["name"], result.path, result.columns) for route, result in parts]
+                    with METRICS.timer("report_encode_seconds", format="xlsx", codec="none"):
+                        path = await REPORT_EXECUTOR.run(generate_dashboard_xlsx, os.path.join(tmp_dir, filename), sheets)
+                    METRICS.observe("report_file_bytes", os.path.getsize(path), format="xlsx")
+                    sent = await message.answer_document(FSInputFile(path, filename=filename), caption=caption)
+                    await FILE_ID_CACHE.put(file_key, [sent.document.file_id])
+            except Exception as e:
+                logger.error("Ошибка при отправке сводки %s: %s", service_id, e)
+                METRICS.inc("report_errors_total", stage="dashboard")
+                await message.answer("Ошибка при формировании сводки.")
+                return
+            if failed:
+                await message.answer("Не вошли в сводку:\n" + "\n".join(
+                    f"{route.config['name']}: {reason}" for route, reason in failed
+                ))
+
+async def dashboard_callback_handler(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    service_id = callback.data.split(":", 1)[1]
+    if not user_has_service(user_id, service_id):
+        await callback.answer("У вас нет доступа к этому сервису.")
+        return
+    if not SERVICE_REGISTRY.dashboard_routes(service_id):
+        await callback.answer("Для этого сервиса нет сводки.")
+        return
+    await callback.answer("Формирую сводку...")
+    await run_dashboard(callback.message, user_id, service_id)
+
+
+async def cancel_job_handler(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    parts = callback.data.split(":")
+    try:
+        job_id = int(parts[-1])
+    except ValueError:
+        await callback.answer("Неверные данные запроса.")
+        return
+    # Кнопки старого формата "cancel:<job_id>" относятся к этой реплике
+    replica = parts[1] if len(parts) == 3 else REPLICA_ID
+    if replica != REPLICA_ID:
+        # Задание выполняется другой репликой: права проверит она
+        await CANCEL_RELAY.publish(replica, job_id, user_id)
+        await callback.answer("Запрос отменяется...")
+        return
+    job = REPORT_SCHEDULER.get(job_id)
+    if job is None:
+        await callback.answer("Запрос уже завершён.")
+        return
+    if not can_cancel_job(job, user_id):
+        await callback.answer("Можно отменить только свой запрос.")
+        return
+    await REPORT_SCHEDULER.cancel(job)
+    await callback.answer("Запрос отменяется...")
+    logger.info("Пользователь %s отменил задание %s", user_id, job_id)
+
+
+async def format_handler(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ALLOWED_USERS:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+    current = (await state.get_data()).get("export_format", "csv")
+    await message.answer(
+        f"Текущий формат выгрузки: {EXPORT_FORMATS[current][0]}. Выберите формат:",
+        reply_markup=get_format_keyboard()
+    )
+
+async def format_callback_handler(callback: types.CallbackQuery, state: FSMContext):
+    export_format = callback.data.split(":", 1)[1]
+    if export_format not in EXPORT_FORMATS:
+        await callback.answer("Неизвестный формат.")
+        return
+    await state.update_data(export_format=export_format)
+    await callback.answer(f"Формат выгрузки: {EXPORT_FORMATS[export_format][0]}")
+    logger.info("Пользователь %s выбрал формат выгрузки %s", callback.from_user.id, export_format)
+
+async def subscribe_handler(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    if user_id not in ALLOWED_USERS:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+    keyboard = SERVICE_REGISTRY.subscribe_keyboard(get_user_department(user_id))
+    if not keyboard.inline_keyboard:
+        await message.answer("Нет отчётов, доступных для подписки.")
+        return
+    await message.answer("Выберите отчёт для ежедневной доставки:", reply_markup=keyboard)
+
+async def subscribe_callback_handler(callback: types.CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    route = SERVICE_REGISTRY.route(callback.data.split(":", 1)[1])
+    if route is None:
+        await callback.answer("Неверные данные запроса.")
+        return
+    service_id, query_config = route.service_id, route.config
+    if not user_has_service(user_id, service_id):
+        await callback.answer("У вас нет доступа к этому отчёту.")
+        return
+    if route.defaults() is None:
+        await callback.answer("На этот отчёт нельзя подписаться: у него нет параметров по умолчанию.")
+        return
+    await state.set_state(SubscriptionSetup.waiting_for_time)
+    await state.update_data(sub_service_id=service_id, sub_callback=query_config["callback"])
+    await callback.answer()
+    await callback.message.answer(
+        f"Отчёт «{query_config['name']}». Введите время доставки в формате ЧЧ:ММ ({SCHEDULE_TIMEZONE.key}):"
+    )
+
+async def subscription_time_handler(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    try:
+        deliver_at = parse_schedule_time(message.text or "")
+    except ValueError:
+        await message.answer("Неверный формат времени. Введите время в формате ЧЧ:ММ, например 09:30.")
+        return
+    data = await state.get_data()
+    service_id, query_key = data.pop("sub_service_id", None), data.pop("sub_callback", None)
+    query_config = get_query_config(service_id, query_key)
+    await state.set_state(None)
+    await state.set_data(data)
+    if not query_config:
+        await message.answer("Отчёт не найден.")
+        return
+    now = datetime.datetime.now(SCHEDULE_TIMEZONE)
+    # Если время на сегодня уже прошло, первая доставка будет завтра
+    last_sent = now.date() if deliver_at <= now.time() else None
+    export_format = data.get("export_format", "csv")
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            INSERT INTO report_subscriptions (user_id, service_id, callback, deliver_at, last_sent, export_format)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (user_id, service_id, callback) DO UPDATE
+            SET deliver_at = EXCLUDED.deliver_at, last_sent = EXCLUDED.last_sent,
+                export_format = EXCLUDED.export_format;
+        """, user_id, service_id, query_key, deliver_at, last_sent, export_format)
+    await message.answer(f"Подписка оформлена: «{query_config['name']}» ежедневно в {deliver_at:%H:%M}.")
+    logger.info("Пользователь %s подписался на отчёт %s в %s", user_id, query_config["name"], deliver_at)
+
+async def subscriptions_handler(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in ALLOWED_USERS:
+        await message.answer("У вас нет доступа к этому боту.")
+        return
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        rows = await conn.fetch("""
+            SELECT service_id, callback, deliver_at FROM report_subscriptions
+            WHERE user_id = $1 ORDER BY deliver_at;
+        """, user_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    for row in rows:
+        route = SERVICE_REGISTRY.find_route(row["service_id"], row["callback"])
+        if route is not None:
+            keyboard.inline_keyboard.append([InlineKeyboardButton(
+                text=f"Отписаться: {route.config['name']} ({row['deliver_at']:%H:%M})",
+                callback_data=f"unsub:{route.id}",
+            )])
+    if not keyboard.inline_keyboard:
+        await message.answer("У вас нет подписок. Оформить: /subscribe")
+        return
+    await message.answer("Ваши подписки:", reply_markup=keyboard)
+
+async def unsubscribe_callback_handler(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    route = SERVICE_REGISTRY.route(callback.data.split(":", 1)[1])
+    if route is None:
+        await callback.answer("Неверные данные запроса.")
+        return
+    service_id, query_config = route.service_id, route.config
+    async with DB_POOLS.acquire(STATS_DB) as conn:
+        await conn.execute("""
+            DELETE FROM report_subscriptions WHERE user_id = $1 AND service_id = $2 AND callback = $3;
+        """, user_id, service_id, query_config["callback"])
+    await callback.answer("Подписка отменена.")
+    await callback.message.answer(f"Подписка на «{query_config['name']}» отменена.")
+
+async def track_activity(message: types.Message):
+    if not message.from_user:
+        return
+    user_id = message.from_user.id
+    text = message.text or ""
+    with METRICS.timer("activity_track_seconds"):
+        ACTIVITY_STATS.add(user_id, len(text))
+
+        # Если сообщение в групповом чате – накапливаем статистику в буфере для записи в БД,
+        # передавая также название чата и топик (если есть)
+        if message.chat.type in ["group", "supergroup"]:
+            chat_title = message.chat.title if hasattr(message.chat, "title") else ""
+            chat_topic = getattr(message.chat, "topic", None)
+            await ACTIVITY_BUFFER.add(message.chat.id, user_id, chat_title, chat_topic, len(text))
+
+async def my_stats_handler(message: types.Message):
+    user_id = message.from_user.id
+    stats = await ACTIVITY_STATS.get(user_id)
+    count = stats.count
+    avg_length = stats.total_length / count if count > 0 else 0
+    await message.answer(f"Ваша активность:\nСообщений: {count}\nСредняя длина: {avg_length:.2f} символов")
+
+def format_metric_value(value: float, unit: str) -> str:
+    if unit == "seconds":
+        return f"{value * 1000:.0f} мс" if value < 1 else f"{value:.2f} с"
+    if unit == "bytes":
+        return f"{value / (1024 * 1024):.2f} МБ" if value >= 1024 * 1024 else f"{value / 1024:.1f} КБ"
+    return f"{value:.0f}"
+
+async def perf_handler(message: types.Message):
+    if get_user_department(message.from_user.id) != "admin":
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    lines = [f"Последние замеры (до {METRICS_WINDOW}), p50 / p90 / p99:"]
+    for name, labels, unit, count, values in METRICS.percentiles():
+        label_text = ", ".join(f"{key}={label}" for key, label in labels)
+        lines.append(f"{name}{f' [{label_text}]' if label_text else ''}, n={count}: "
+                     + " / ".join(format_metric_value(value, unit) for value in values))
+    counters = METRICS.counters()
+    if counters:
+        lines.append("")
+        lines.append("Счётчики:")
+        for name, labels, value in counters:
+            label_text = ", ".join(f"{key}={label}" for key, label in labels)
+            lines.append(f"{name}{f' [{label_text}]' if label_text else ''}: {value:g}")
+    if len(lines) == 1:
+        await message.answer("Замеров пока нет.")
+        return
+    # Длина сообщения Telegram ограничена 4096 символами
+    text = ""
+    for line in lines:
+        if len(text) + len(line) + 1 > 4000:
+            await message.answer(text)
+            text = ""
+        text += line + "\n"
+    await message.answer(text)
+
+async def render_all_stats_page(page: int):
+    rows, total = await ACTIVITY_STATS.page(page * ALL_STATS_PAGE_SIZE, ALL_STATS_PAGE_SIZE)
+    if not rows:
+        return None, None
+    pages = (total + ALL_STATS_PAGE_SIZE - 1) // ALL_STATS_PAGE_SIZE
+    lines = [f"Активность пользователей, страница {page + 1} из {pages}:"]
+    for row in rows:
+        count = row["message_count"]
+        avg_length = row["total_length"] / count if count > 0 else 0
+        lines.append(f"User {row['user_id']}: сообщений {count}, ср. длина {avg_length:.2f}")
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀", callback_data=f"stats:{page - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(text="▶", callback_data=f"stats:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[buttons] if buttons else [])
+
+async def all_stats_handler(message: types.Message):
+    user_id = message.from_user.id
+    if get_user_department(user_id) != "admin":
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+
+    text, keyboard = await render_all_stats_page(0)
+    if text is None:
+        await message.answer("Нет данных по активности.")
+        return
+    await message.answer(text, reply_markup=keyboard)
+
+async def all_stats_page_handler(callback: types.CallbackQuery):
+    if get_user_department(callback.from_user.id) != "admin":
+        await callback.answer("У вас нет доступа к этой команде.")
+        return
+    try:
+        page = max(int(callback.data.split(":", 1)[1]), 0)
+    except ValueError:
+        await callback.answer("Неверные данные запроса.")
+        return
+    text, keyboard = await render_all_stats_page(page)
+    await callback.answer()
+    if text is None:
+        return
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_text(text, reply_markup=keyboard)
+
+# ----------------------------
+# Регистрация хэндлеров через Dispatcher
+# ----------------------------
+
+def register_handlers(dp: Dispatcher):
+    dp.message.register(start_handler, Command("start"))
+    dp.message.register(format_handler, Command("format"))
+    dp.message.register(subscribe_handler, Command("subscribe"))
+    dp.message.register(subscriptions_handler, Command("subscriptions"))
+    dp.message.register(my_stats_handler, Command("my_stats"))
+    dp.message.register(all_stats_handler, Command("all_stats"))
+    dp.message.register(perf_handler, Command("perf"))
+    dp.message.register(subscription_time_handler, SubscriptionSetup.waiting_for_time)
+    dp.message.register(query_param_handler, QueryParams.waiting_for_value)
+    dp.message.register(service_selection_handler, ServiceSelection.waiting_for_service)
+    dp.message.register(track_activity)
+    dp.callback_query.register(cancel_job_handler, lambda c: c.data and c.data.startswith("cancel:"))
+    dp.callback_query.register(format_callback_handler, lambda c: c.data and c.data.startswith("fmt:"))
+    dp.callback_query.register(subscribe_callback_handler, lambda c: c.data and c.data.startswith("sub:"))
+    dp.callback_query.register(unsubscribe_callback_handler, lambda c: c.data and c.data.startswith("unsub:"))
+    dp.callback_query.register(all_stats_page_handler, lambda c: c.data and c.data.startswith("stats:"))
+    dp.callback_query.register(dashboard_callback_handler, lambda c: c.data and c.data.startswith("dash:"))
+    dp.callback_query.register(query_callback_handler, lambda c: c.data and (":" in c.data))
+
+# ----------------------------
+# Основной запуск бота
+# ----------------------------
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """
+    Приём обновлений через вебхук до получения SIGINT/SIGTERM.
+    Все реплики за балансировщиком регистрируют один и тот же WEBHOOK_URL, поэтому
+    при остановке реплики вебхук не удаляется – его продолжают обслуживать остальные.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stopped.set)
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                              allowed_updates=dp.resolve_used_update_types())
+        logger.info("Вебхук %s принимается на %s:%s%s", WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stopped.wait()
+    finally:
+        # Обработчик вебхука закрывает и сессию бота
+        await runner.cleanup()
+
+async def main():
+    global DB_POOLS, ACTIVITY_BUFFER, REPORT_EXECUTOR, RESULT_CACHE, FILE_ID_CACHE, ROLLUP_WORKER
+    global REPORT_SCHEDULER, REPORT_PLANNER, SERVICE_REGISTRY, ACTIVITY_STATS, METRICS_SERVER, CANCEL_RELAY
+    SERVICE_REGISTRY = ServiceRegistry(SERVICES_CONFIG, SERVICE_QUERIES, {*DATABASE_URLS, STATS_DB})
+    DB_POOLS = PoolRegistry({**DATABASE_URLS, STATS_DB: STATS_DB_URL}, DB_POOL_SIZES, DB_REPLICA_URLS)
+    ACTIVITY_BUFFER = ActivityBuffer(ACTIVITY_FLUSH_INTERVAL, ACTIVITY_FLUSH_SIZE, ACTIVITY_BUFFER_LIMIT)
+    ACTIVITY_STATS = ActivityStatsStore(ACTIVITY_STATS_MAX_USERS, ACTIVITY_STATS_SNAPSHOT_INTERVAL)
+    REPORT_EXECUTOR = ReportExecutor(REPORT_EXECUTOR_KIND, REPORT_EXECUTOR_WORKERS)
+    RESULT_CACHE = ResultCache(RESULT_CACHE_MAX_BYTES, REPORTS_TMP_DIR, RESULT_CACHE_PRELOAD_MAX_BYTES)
+    FILE_ID_CACHE = FileIdCache()
+    ROLLUP_WORKER = RollupWorker(ROLLUP_INTERVAL)
+    REPORT_SCHEDULER = ReportScheduler(DB_CONCURRENCY, DB_CONCURRENCY_DEFAULT)
+    CANCEL_RELAY = CancelRelay(REPORT_SCHEDULER, STATS_DB_URL)
+    bot = Bot(token=BOT_TOKEN)
+    REPORT_PLANNER = ReportPlanner(bot)
+    METRICS_SERVER = MetricsServer(METRICS, METRICS_HOST, METRICS_PORT)
+    storage = PostgresStorage(ALLOWED_USERS) if FSM_STORAGE == "postgres" else MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    register_handlers(dp)
+    try:
+        # Запуск миграций перед стартом бота
+        await run_migrations()
+        DB_POOLS.start_health_checks()
+        ACTIVITY_BUFFER.start()
+        await ACTIVITY_STATS.warm()
+        ACTIVITY_STATS.start()
+        ROLLUP_WORKER.start()
+        REPORT_PLANNER.start()
+        CANCEL_RELAY.start()
+        await METRICS_SERVER.start()
+        logger.info("Бот запускается в режиме %s (реплика %s)...", BOT_MODE, REPLICA_ID)
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await METRICS_SERVER.stop()
+        await CANCEL_RELAY.stop()
+        await REPORT_PLANNER.stop()
+        await REPORT_SCHEDULER.close()
+        await ROLLUP_WORKER.stop()
+        await ACTIVITY_BUFFER.stop()
+        await ACTIVITY_STATS.stop()
+        await DB_POOLS.close()
+        REPORT_EXECUTOR.shutdown()
+        RESULT_CACHE.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,40 @@
+import asyncio
+import uuid
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import bot
+
+
+class Record(tuple):
+    columns = ("amount", "ratio", "id")
+
+    def keys(self):
+        return self.columns
+
+
+def spool(path, chunks):
+    async def records():
+        for chunk in chunks:
+            yield [Record(row) for row in chunk]
+    columns, _, _ = asyncio.run(bot.spool_records(records(), path))
+    return columns
+
+
+def test_parquet_keeps_numeric_precision(tmp_path):
+    spool_path = str(tmp_path / "result.spool")
+    row_id = uuid.uuid4()
+    columns = spool(spool_path, [
+        [(Decimal("12.34"), Decimal("1.1234567890123456789012"), row_id)],
+        [(Decimal("123456789012345.123456789"), Decimal("2"), None)],
+    ])
+    path, offset = bot.generate_parquet(spool_path, columns, str(tmp_path / "result.parquet"), row_group_size=1)
+    table = pq.read_table(path)
+    assert offset is None
+    assert table.schema.field("amount").type == pa.decimal128(38, 18)
+    assert table.column("amount").to_pylist() == [Decimal("12.34"), Decimal("123456789012345.123456789")]
+    # Масштаб больше фиксированного – строкой, без округления
+    assert table.column("ratio").to_pylist() == ["1.1234567890123456789012", "2"]
+    assert table.column("id").to_pylist() == [str(row_id), None]
@@ -0,0 +1,70 @@
+import asyncio
+
+import bot
+
+
+def make_job(scheduler, runner, db_instance="stats"):
+    return scheduler.create_job(1, "report", db_instance, "kpi", runner)
+
+
+async def wait_forever(job):
+    await asyncio.Event().wait()
+
+
+def test_cancel_right_after_dispatch_releases_slot():
+    async def scenario():
+        scheduler = bot.ReportScheduler({"stats": 1}, 1)
+        first = make_job(scheduler, wait_forever)
+        await scheduler.submit(first)
+        # Задача создана, но _run ещё не начал выполняться
+        await scheduler.cancel(first)
+        await asyncio.gather(first.task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert first.task.cancelled()
+        assert not scheduler._running["stats"]
+        assert scheduler.get(first.id) is None
+
+        done = asyncio.Event()
+
+        async def finish(job):
+            done.set()
+
+        second = make_job(scheduler, finish)
+        await scheduler.submit(second)
+        await asyncio.wait_for(done.wait(), timeout=1)
+        await asyncio.sleep(0)
+        assert not scheduler._running["stats"]
+
+    asyncio.run(scenario())
+
+
+def test_cancel_running_job_releases_slot():
+    async def scenario():
+        scheduler = bot.ReportScheduler({"stats": 1}, 1)
+        job = make_job(scheduler, wait_forever)
+        await scheduler.submit(job)
+        await asyncio.sleep(0.01)
+        await scheduler.cancel(job)
+        await asyncio.gather(job.task, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert not scheduler._running["stats"]
+        assert scheduler.get(job.id) is None
+
+    asyncio.run(scenario())
+
+
+def test_jobs_beyond_limit_wait_in_queue():
+    async def scenario():
+        scheduler = bot.ReportScheduler({"stats": 1}, 1)
+        first = make_job(scheduler, wait_forever)
+        second = make_job(scheduler, wait_forever)
+        await scheduler.submit(first)
+        await scheduler.submit(second)
+        assert scheduler.position(second) == 1
+        await scheduler.cancel(first)
+        await asyncio.sleep(0.01)
+        assert scheduler.position(second) == 0
+        assert second in scheduler._running["stats"]
+        await scheduler.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+import asyncio
+
+import bot
+
+
+def loader(size):
+    async def load(path):
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return ["value"], 1, f"digest-{size}"
+    return load
+
+
+def test_preload_larger_than_regular_budget_is_kept(tmp_path):
+    async def scenario():
+        cache = bot.ResultCache(100, str(tmp_path), preload_max_bytes=1000)
+        assert await cache.preload("export", 60, loader(500))
+        assert cache.has("export")
+        # Обычные результаты не вытесняют заранее подготовленный
+        async with cache.use("kpi-1", 60, loader(80)):
+            pass
+        async with cache.use("kpi-2", 60, loader(80)):
+            pass
+        assert cache.has("export")
+        assert cache.has("kpi-2")
+        assert not cache.has("kpi-1")
+        cache.close()
+
+    asyncio.run(scenario())
+
+
+def test_preload_over_its_budget_is_dropped(tmp_path):
+    async def scenario():
+        cache = bot.ResultCache(100, str(tmp_path), preload_max_bytes=1000)
+        assert not await cache.preload("export", 60, loader(2000))
+        assert not cache.has("export")
+        assert await cache.preload("first", 60, loader(600))
+        assert await cache.preload("second", 60, loader(600))
+        assert not cache.has("first")
+        assert cache.has("second")
+        cache.close()
+
+    asyncio.run(scenario())